@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Load-generation benchmark for socketConsole.  Starts a console server in
+# this process, drives it over loopback from client threads, and prints
+# the results as JSON so runs of different versions can be compared.
+# Use --help for the options.
+
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import threading
+
+import socketConsole
+import consoleClient
+
+kPrompt = b'>>> '
+
+# Resident set size of this process in bytes (Linux only; 0 elsewhere).
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+    return dict(count=len(samples), min=samples[0], p50=at(50), p90=at(90),
+            p99=at(99), max=samples[-1])
+
+# Run fn(i) on n threads at once and return the results, in order.
+def concurrently(n, fn):
+    results = [None] * n
+    def run(i):
+        results[i] = fn(i)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+class Prompter:
+
+    # An interactive console client that waits for each prompt.
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.data = bytearray()
+        self.readPrompt()
+
+    # Read up to and including the next prompt; return the byte count.
+    def readPrompt(self):
+        while not self.data.endswith(kPrompt):
+            chunk = self.sock.recv(1 << 16)
+            if not chunk:
+                raise EOFError('console closed the connection')
+            self.data.extend(chunk)
+        n = len(self.data)
+        self.data.clear()
+        return n
+
+    def run(self, line):
+        self.sock.sendall(line.encode() + b'\n')
+        return self.readPrompt()
+
+    def close(self):
+        self.sock.close()
+
+def benchAccept(address, count):
+    # Connections per second, each doing the RPC handshake and one call.
+    start = time.perf_counter()
+    for i in range(count):
+        with consoleClient.RpcClient(address) as c:
+            c.call('0')
+    elapsed = time.perf_counter() - start
+    return dict(connections=count, seconds=elapsed, perSecond=count / elapsed)
+
+def benchLatency(address, clients, rounds):
+    # Time from sending a line to getting the next prompt back.
+    def client(i):
+        p = Prompter(address)
+        times = list()
+        for r in range(rounds):
+            start = time.perf_counter()
+            p.run('1')
+            times.append(time.perf_counter() - start)
+        p.close()
+        return times
+    samples = [t for times in concurrently(clients, client) for t in times]
+    return percentiles(samples)
+
+def benchThroughput(address, clients, statements):
+    # Pipelined RPC statements per second over all clients.
+    def client(i):
+        with consoleClient.RpcClient(address) as c:
+            c.callMany(['x = {}'.format(n) for n in range(statements)])
+    start = time.perf_counter()
+    concurrently(clients, client)
+    elapsed = time.perf_counter() - start
+    total = clients * statements
+    return dict(statements=total, seconds=elapsed, perSecond=total / elapsed)
+
+def benchOutput(address, clients, size, rounds):
+    # Bytes per second of printed output streamed back to the clients.
+    def client(i):
+        p = Prompter(address)
+        received = 0
+        for r in range(rounds):
+            received += p.run('print("x" * {})'.format(size))
+        p.close()
+        return received
+    start = time.perf_counter()
+    received = sum(concurrently(clients, client))
+    elapsed = time.perf_counter() - start
+    return dict(bytes=received, seconds=elapsed, bytesPerSecond=received /
+            elapsed)
+
+def benchMemory(address, sessions):
+    # Growth in RSS per idle interactive session.
+    before = rss()
+    prompters = [Prompter(address) for i in range(sessions)]
+    after = rss()
+    for p in prompters:
+        p.close()
+    return dict(sessions=sessions, rssBefore=before, rssAfter=after,
+            bytesPerSession=(after - before) / sessions)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark socketConsole over loopback and print JSON.')
+    parser.add_argument('--clients', type=int, default=8,
+        help='Number of concurrent client connections.')
+    parser.add_argument('--rounds', type=int, default=200,
+        help='Prompt round trips per client for the latency test.')
+    parser.add_argument('--statements', type=int, default=2000,
+        help='Pipelined statements per client for the throughput test.')
+    parser.add_argument('--accepts', type=int, default=200,
+        help='Connections to open for the accept rate test.')
+    parser.add_argument('--output-size', type=int, default=1 << 20,
+        help='Bytes each statement prints in the output test.')
+    parser.add_argument('--sessions', type=int, default=50,
+        help='Idle sessions to open for the memory test.')
+    parser.add_argument('--output', help='Write the JSON here, not stdout.')
+    args = parser.parse_args()
+
+    maxSessions = max(args.clients, args.sessions) + 1
+    socketConsole.start(0, '127.0.0.1', multiple=True, wait=False,
+            maxSessions=maxSessions, symtab=dict())
+    address = socketConsole.address()
+    # The server's own diagnostics would swamp the results.
+    socketConsole.verbose = False
+    try:
+        results = dict(
+            python=sys.version,
+            platform=platform.platform(),
+            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            args=vars(args),
+            accept=benchAccept(address, args.accepts),
+            latency=benchLatency(address, args.clients, args.rounds),
+            throughput=benchThroughput(address, args.clients,
+                    args.statements),
+            output=benchOutput(address, args.clients, args.output_size, 5),
+            memory=benchMemory(address, args.sessions),
+            server=socketConsole.metrics())
+    finally:
+        socketConsole.stop()
+    del results['server']['sessions']
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
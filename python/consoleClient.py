@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Client for the machine-readable RPC protocol socketConsole serves on the
+# same port as the interactive console (see socketConsole._RpcConsole).
+
+import json
+import socket
+import struct
+import itertools
+
+kRpcHandshake = b'\0'
+
+class RpcClient:
+
+    # Usage:
+    #     c = RpcClient(('somehost', 5000))
+    #     c.call('len(bigTable)')['result']
+    # call() waits for its answer; send() and receive() let a caller keep
+    # many requests outstanding on the one connection.
+
+    # address is (host, port), or a Unix domain socket path ('@name' for
+    # Linux's abstract namespace).
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            if address.startswith('@'):
+                address = '\0' + address[1:]
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(address, timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(kRpcHandshake)
+        self.ids = itertools.count()
+        self.inbuf = bytearray()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *junk):
+        self.close()
+
+    # Send a request and return its id without waiting for the response.
+    def send(self, source, mode=None):
+        if mode is None:
+            return self.sendRequest(source=source)
+        return self.sendRequest(source=source, mode=mode)
+
+    # Send a request with any fields, e.g. sendRequest(op='items', ...).
+    def sendRequest(self, **request):
+        ident = request['id'] = next(self.ids)
+        payload = json.dumps(request).encode()
+        self.sock.sendall(struct.pack('>I', len(payload)) + payload)
+        return ident
+
+    # Return the next response (a dict) to arrive.
+    def receive(self):
+        while True:
+            if len(self.inbuf) >= 4:
+                size, = struct.unpack_from('>I', self.inbuf)
+                if len(self.inbuf) >= 4 + size:
+                    frame = bytes(self.inbuf[4:4 + size])
+                    del self.inbuf[:4 + size]
+                    return json.loads(frame)
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError('console closed the connection')
+            self.inbuf.extend(data)
+
+    def call(self, source, mode=None):
+        self.send(source, mode)
+        return self.receive()
+
+    # Make a request and return its result, raising RemoteError if it
+    # failed.  Only for use while no other requests are outstanding.
+    def request(self, **request):
+        self.sendRequest(**request)
+        response = self.receive()
+        if response['exception'] is not None:
+            raise RemoteError(response['exception']['type'],
+                    response['exception']['text'])
+        return response['result']
+
+    # Evaluate source and return a RemoteObject for browsing its value.
+    def inspect(self, source):
+        return RemoteObject(self, self.request(op='inspect', source=source))
+
+    # Run many requests with all of them in flight at once, and return
+    # the responses in the same order.
+    def callMany(self, sources, mode=None):
+        ids = [self.send(source, mode) for source in sources]
+        responses = dict()
+        while len(responses) < len(ids):
+            response = self.receive()
+            responses[response['id']] = response
+        return [responses[i] for i in ids]
+
+class RemoteError(Exception):
+    # A request failed in the console.  args are the exception's type name
+    # and its traceback text.
+    pass
+
+class RemoteObject:
+
+    # An object in the console, browsed by handle.  Only what's asked for
+    # is sent: e.g.
+    #     table = client.inspect('bigTable')
+    #     table.len, table.items(0, 20), table.item(7).attrs()
+
+    def __init__(self, client, description):
+        self.client = client
+        self.handle = description['handle']
+        self.type = description['type']
+        self.repr = description['repr']
+        self.len = description['len']
+
+    def __repr__(self):
+        return '<RemoteObject {} {}: {}>'.format(self.handle, self.type,
+                self.repr)
+
+    # Lists of [name, {"type", "repr", "len"}].
+    def attrs(self, start=0, count=100):
+        return self.client.request(op='attrs', handle=self.handle,
+                start=start, count=count)
+
+    # Lists of [key repr or position, {"type", "repr", "len"}].
+    def items(self, start=0, count=100):
+        return self.client.request(op='items', handle=self.handle,
+                start=start, count=count)
+
+    def attr(self, name):
+        return RemoteObject(self.client, self.client.request(op='get',
+                handle=self.handle, attr=name))
+
+    # The value of the index'th item, as listed by items().
+    def item(self, index):
+        return RemoteObject(self.client, self.client.request(op='get',
+                handle=self.handle, index=index))
+
+    def release(self):
+        self.client.request(op='release', handles=[self.handle])
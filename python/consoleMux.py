@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Run the same statement in many socketConsole processes at once, e.g. all
+# the worker processes of a service, and merge the answers: processes that
+# answered the same are listed together, as are those that failed the same
+# way.  It takes about as long as the slowest process, not the sum.
+#
+# Command line, use --help for details:
+#     consoleMux.py -c 'len(cache)' host1:5000 host1:5001 host2:5000
+# or, from Python:
+#     mux = consoleMux.Multiplexer(['host1:5000', 'host1:5001'])
+#     print(mux.run('len(cache)'))
+# With --serve, it instead starts a socketConsole of its own with a mux
+# in its namespace, so people can share one connection to the fleet.
+
+import sys
+import socket
+import argparse
+import threading
+import concurrent.futures
+
+import consoleClient
+
+# Turn "host:port", ":port", "port", "/unix/path" or "@abstract" into an
+# address RpcClient takes.
+def parseEndpoint(text):
+    if not isinstance(text, str):
+        return text
+    if text.startswith('/') or text.startswith('@'):
+        return text
+    host, junk, port = text.rpartition(':')
+    return (host or 'localhost', int(port))
+
+class Multiplexer:
+
+    # endpoints are in any form parseEndpoint() takes; one given twice is
+    # only asked once.  Each gets its own connection, kept open between
+    # runs; timeout (sec) is how long each has to answer.
+
+    def __init__(self, endpoints, timeout=5.0):
+        self.endpoints = list(dict.fromkeys(parseEndpoint(e)
+                for e in endpoints))
+        self.timeout = timeout
+        self.clients = dict()   # endpoint -> RpcClient
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(self.endpoints)),
+                thread_name_prefix='consoleMux')
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+    # Run source everywhere and return the Results.
+    def run(self, source, mode=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        futures = [self.executor.submit(self._call, e, source, mode, timeout)
+                for e in self.endpoints]
+        return Results([f.result() for f in futures])
+
+    # Run source on one endpoint; returns (endpoint, key, response) where
+    # key is what's compared to group answers.
+    def _call(self, endpoint, source, mode, timeout):
+        with self.lock:
+            client = self.clients.pop(endpoint, None)
+        try:
+            if client is None:
+                client = consoleClient.RpcClient(endpoint, timeout)
+            client.sock.settimeout(timeout)
+            response = client.call(source, mode)
+        except (OSError, EOFError, ValueError) as e:
+            # The connection may still have an answer on the way, so it
+            # can't be used again.
+            if client is not None:
+                client.close()
+            error = 'timed out' if isinstance(e, socket.timeout) else \
+                    '{}: {}'.format(type(e).__name__, e)
+            return endpoint, ('unreachable', error), None
+        # Runs can overlap (e.g. several --serve sessions sharing a mux),
+        # and then only one connection per endpoint is kept.
+        with self.lock:
+            kept = self.clients.setdefault(endpoint, client)
+        if kept is not client:
+            client.close()
+        exception = response['exception']
+        if exception is not None:
+            # Group by the last line of the traceback, e.g.
+            # "KeyError: 'x'", so differing paths don't split the group.
+            lines = exception['text'].strip().splitlines()
+            return endpoint, ('error', lines[-1] if lines else
+                    exception['type']), response
+        return endpoint, ('ok', response['result'], response['stdout']), \
+                response
+
+class Results:
+
+    # The answers from one Multiplexer.run().  groups maps each distinct
+    # answer to the endpoints that gave it; responses maps each endpoint to
+    # its full response (None if it couldn't be reached).
+
+    def __init__(self, answers):
+        self.groups = dict()
+        self.responses = dict()
+        for endpoint, key, response in answers:
+            self.groups.setdefault(key, list()).append(endpoint)
+            self.responses[endpoint] = response
+
+    @property
+    def ok(self):
+        return all(key[0] == 'ok' for key in self.groups)
+
+    def __str__(self):
+        lines = list()
+        # Biggest groups first
+        for key, endpoints in sorted(self.groups.items(),
+                key=lambda item: -len(item[1])):
+            names = ', '.join(_endpointName(e) for e in endpoints)
+            lines.append('== {} of {}: {}'.format(len(endpoints),
+                    len(self.responses), names))
+            if key[0] == 'ok':
+                result, stdout = key[1], key[2]
+                if stdout:
+                    lines.append(stdout.rstrip('\n'))
+                if result is not None:
+                    lines.append(result)
+            else:
+                lines.append('{}: {}'.format(key[0], key[1]))
+        return '\n'.join(lines) + '\n'
+
+def _endpointName(endpoint):
+    if isinstance(endpoint, tuple):
+        return '{}:{}'.format(*endpoint)
+    return endpoint
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a statement in many socketConsole processes at once'
+                ' and merge the answers.')
+    parser.add_argument('endpoints', nargs='+',
+        help='Consoles as host:port, :port, /unix/path or @abstract.')
+    parser.add_argument('-c', '--command',
+        help='Statement to run; if omitted, one per line from stdin.')
+    parser.add_argument('--timeout', type=float, default=5.0,
+        help='Seconds each console has to answer.')
+    parser.add_argument('--serve', metavar='PORT',
+        help='Instead, serve a console (on a port or Unix socket path)'
+                ' with "mux" set to a Multiplexer for the endpoints.')
+    args = parser.parse_args()
+
+    mux = Multiplexer(args.endpoints, args.timeout)
+    try:
+        if args.serve is not None:
+            import socketConsole
+            port = int(args.serve) if args.serve.isdigit() else args.serve
+            socketConsole.start(port, multiple=True, symtab=dict(mux=mux))
+            return 0
+        commands = [args.command] if args.command is not None else \
+                (line.rstrip('\n') for line in sys.stdin)
+        status = 0
+        for command in commands:
+            if not command.strip():
+                continue
+            results = mux.run(command)
+            sys.stdout.write(str(results))
+            if not results.ok:
+                status = 1
+        return status
+    finally:
+        mux.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Sampling profiler for a live process.  A background thread looks at
+# every thread's stack (sys._current_frames()) every so often and counts
+# how many times each distinct stack was seen.  Nothing runs while it's
+# stopped, and at the default 100 samples a second it's cheap enough to
+# leave running.
+#
+# Usage, e.g. from a socketConsole session (see its %profile command):
+#     import sampleProfiler
+#     sampleProfiler.profiler.start()
+#     ...
+#     print(sampleProfiler.profiler.report())
+
+import os
+import sys
+import threading
+import collections
+
+class SampleProfiler:
+
+    # interval is the time (sec) between samples.  At most maxStacks
+    # distinct stacks are counted, each at most maxDepth frames deep
+    # (the innermost ones); samples of any further stacks are only counted
+    # in dropped.  Functions are told apart by file, name and first line,
+    # not by code object, so no code is kept alive, and after maxFunctions
+    # of them any others all count as one.  So memory stays bounded however
+    # long it runs.
+
+    def __init__(self, interval=0.01, maxStacks=20000, maxDepth=64,
+            maxFunctions=10000):
+        self.interval = interval
+        self.maxStacks = maxStacks
+        self.maxDepth = maxDepth
+        self.maxFunctions = maxFunctions
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopRequest = threading.Event()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # Stacks are tuples of function numbers, outermost first.
+            self.stacks = collections.Counter()
+            # (file, name, first line) -> function number
+            self.functions = dict()
+            # function number -> label; 0 is for the functions not kept
+            self.labels = ['(other functions)']
+            self.samples = 0
+            self.dropped = 0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self.thread is not None:
+            return
+        self.stopRequest.clear()
+        self.thread = threading.Thread(target=self._run,
+                name='sampleProfiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopRequest.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        try:
+            # Be nice to the threads being profiled (Linux lets us set the
+            # priority of just this thread).
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        me = threading.get_ident()
+        while not self.stopRequest.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident != me:
+                        self._count(frame)
+            del frames
+
+    def _count(self, frame):
+        functions = self.functions
+        stack = list()
+        while frame is not None and len(stack) < self.maxDepth:
+            code = frame.f_code
+            key = (code.co_filename, code.co_name, code.co_firstlineno)
+            number = functions.get(key)
+            if number is None:
+                if len(functions) < self.maxFunctions:
+                    number = functions[key] = len(self.labels)
+                    self.labels.append('{} ({}:{})'.format(code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno))
+                else:
+                    number = 0
+            stack.append(number)
+            frame = frame.f_back
+        stack.reverse()
+        stack = tuple(stack)
+        self.samples += 1
+        if stack in self.stacks or len(self.stacks) < self.maxStacks:
+            self.stacks[stack] += 1
+        else:
+            self.dropped += 1
+
+    # Return the n functions with the most samples as a printable table.
+    # "self" counts samples where the function was running, "total" those
+    # where it was anywhere on the stack.
+    def report(self, n=20):
+        selfCounts = collections.Counter()
+        totalCounts = collections.Counter()
+        with self.lock:
+            for stack, count in self.stacks.items():
+                if stack:
+                    selfCounts[stack[-1]] += count
+                for number in set(stack):
+                    totalCounts[number] += count
+            labels = list(self.labels)
+            samples = self.samples
+            dropped = self.dropped
+        lines = ['{} samples, {} in stacks not kept, every {} s'.format(
+                samples, dropped, self.interval),
+                '{:>7} {:>6} {:>7} {:>6}  function'.format(
+                'self', '%', 'total', '%')]
+        scale = 100.0 / max(samples, 1)
+        for number, count in selfCounts.most_common(n):
+            total = totalCounts[number]
+            lines.append('{:>7} {:>6.1f} {:>7} {:>6.1f}  {}'.format(
+                    count, count * scale, total, total * scale,
+                    labels[number]))
+        return '\n'.join(lines) + '\n'
+
+    # Generate the samples in "folded stack" form, one line per distinct
+    # stack, for flame graph tools: "outer;inner;innermost count".
+    def folded(self):
+        with self.lock:
+            stacks = list(self.stacks.items())
+            labels = list(self.labels)
+        for stack, count in stacks:
+            yield '{} {}\n'.format(';'.join(labels[i] for i in stack), count)
+
+# The profiler for the process; one is enough.
+profiler = SampleProfiler()
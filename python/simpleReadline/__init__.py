@@ -2,6 +2,14 @@
 # GNU readline package (which is available only on Linux).
 
 from simpleReadline.main import configure
-from simpleReadline.interpretKeys import addByte
+from simpleReadline.editor import LineEditor
+from simpleReadline.history import HistoryStore
 import simpleReadline.history
+import simpleReadline.main
+
+# The default editor's own methods, rather than interpretKeys' functions
+# that look it up every time: addByte() is called for every key.
+# configure() changes that editor in place, so these stay good.
+addByte = simpleReadline.main.editor.addByte
+addBytes = simpleReadline.main.editor.addBytes
 
@@ -0,0 +1,204 @@
+# Simplified version of Python readline module that does not require the
+# GNU readline package (which is available only on Linux).
+
+# Tab completion of names and attributes, without evaluating anything.
+# The names in the context (the namespace being typed into), its builtins
+# and any layers under them (see socketConsole._BaseNamespace), plus the
+# keywords, are kept in a trie.  At each Tab the trie is brought up to date
+# with the names added and removed since last time, rather than built
+# again.  Only the context is compared name by name; the builtins and
+# layers (big module namespaces, which seldom change) are compared only when
+# their size has changed, so a name replaced by another there is missed
+# until something else is added or removed.  For "a.b.c", a is looked up in those namespaces and b with
+# inspect.getattr_static(), so no properties or __getattr__ run.  The
+# attributes an object gets from its type are cached for the last maxTypes
+# types used.
+
+import re
+import inspect
+import keyword
+import builtins
+import collections
+
+# A name or dotted name at the end of the text; the last part may be empty.
+_word = re.compile(r'[^\W\d]\w*(?:\.\w*)*$')
+
+class Completer:
+
+    __slots__ = (
+        'context',    # the namespace dict, or None
+        'trie',       # nested dicts, one level per character; '' marks a name
+        'counts',     # name -> how many of the namespaces (or keywords) have it
+        'known',      # id(namespace) -> (namespace, set of its names)
+        'attrCache',  # type -> sorted names it has, most recently used last
+        'maxTypes',
+    )
+
+    def __init__(self, context, maxTypes=256):
+        self.context = context
+        self.trie = dict()
+        self.counts = dict()
+        self.known = dict()
+        self.attrCache = collections.OrderedDict()
+        self.maxTypes = maxTypes
+        for name in keyword.kwlist:
+            self._add(name)
+
+    # What the last word of text (the line up to the cursor) could be
+    # completed to: returns the part of the word being completed and the
+    # list of the candidates for it.
+    def complete(self, text):
+        match = _word.search(text)
+        if match is None or text[:match.start()].endswith('.'):
+            # e.g. "f()." can't be done without calling f.
+            return '', []
+        word = match.group()
+        expr, dot, prefix = word.rpartition('.')
+        if not dot:
+            self.update()
+            names = self._names(prefix)
+        else:
+            try:
+                obj = self._resolve(expr)
+            except (LookupError, AttributeError):
+                return prefix, []
+            names = [name for name in self._attrs(obj)
+                    if name.startswith(prefix)]
+        if not prefix.startswith('_'):
+            names = [name for name in names if not name.startswith('_')]
+        return prefix, names
+
+    # The namespaces names come from, in the order they're looked up.
+    def _namespaces(self):
+        context = self.context
+        if context is None:
+            return [builtins.__dict__]
+        base = context.get('__builtins__', builtins)
+        if not isinstance(base, dict):
+            base = vars(base)
+        return [context] + list(getattr(base, 'layers', ())) + [base]
+
+    # Bring the trie up to date with the namespaces.
+    def update(self):
+        known = dict()
+        for namespace in self._namespaces():
+            old = self.known.pop(id(namespace), None)
+            if old is None or old[0] is not namespace:
+                names = set(namespace)
+                for name in names:
+                    self._add(name)
+            elif namespace is not self.context and \
+                    len(namespace) == len(old[1]):
+                names = old[1]
+            else:
+                # Compared in place, which doesn't copy all the names.  The
+                # sizes say whether any were removed.
+                names = old[1]
+                added = namespace.keys() - names
+                if len(names) + len(added) == len(namespace):
+                    removed = set()
+                else:
+                    removed = names - namespace.keys()
+                for name in added:
+                    self._add(name)
+                for name in removed:
+                    self._remove(name)
+                names |= added
+                names -= removed
+            known[id(namespace)] = (namespace, names)
+        # Namespaces no longer there
+        for namespace, names in self.known.values():
+            for name in names:
+                self._remove(name)
+        self.known = known
+
+    def _add(self, name):
+        if not isinstance(name, str):
+            return
+        count = self.counts.get(name, 0)
+        self.counts[name] = count + 1
+        if count:
+            return
+        node = self.trie
+        for c in name:
+            node = node.setdefault(c, dict())
+        node[''] = True
+
+    def _remove(self, name):
+        if not isinstance(name, str):
+            return
+        count = self.counts.pop(name) - 1
+        if count:
+            self.counts[name] = count
+            return
+        path = [self.trie]
+        for c in name:
+            path.append(path[-1][c])
+        del path[-1]['']
+        # Prune the nodes left empty
+        for i in range(len(name), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][name[i - 1]]
+
+    # The names in the trie that start with prefix.
+    def _names(self, prefix):
+        node = self.trie
+        for c in prefix:
+            node = node.get(c)
+            if node is None:
+                return []
+        names = list()
+        stack = [(prefix, node)]
+        while stack:
+            text, node = stack.pop()
+            for c, child in node.items():
+                if c:
+                    stack.append((text + c, child))
+                else:
+                    names.append(text)
+        return names
+
+    # The object a dotted name refers to.
+    def _resolve(self, expr):
+        first, *rest = expr.split('.')
+        for namespace in self._namespaces():
+            if first in namespace:
+                obj = namespace[first]
+                break
+        else:
+            raise LookupError(first)
+        for name in rest:
+            obj = inspect.getattr_static(obj, name)
+        return obj
+
+    # The attribute names of obj: those from its type, cached, and its own.
+    def _attrs(self, obj):
+        kind = type(obj)
+        cache = self.attrCache
+        names = cache.get(kind)
+        if names is None:
+            names = _classNames(kind)
+            cache[kind] = names
+            if len(cache) > self.maxTypes:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(kind)
+        own = set()
+        if isinstance(obj, type):
+            own.update(_classNames(obj))
+        try:
+            own.update(object.__getattribute__(obj, '__dict__'))
+        except (AttributeError, TypeError):
+            pass
+        if own:
+            own.update(names)
+            return sorted(name for name in own if isinstance(name, str))
+        return names
+
+# The names a class's instances get from it and its bases, sorted.
+def _classNames(klass):
+    names = set()
+    for base in klass.__mro__:
+        names.update(base.__dict__)
+    return sorted(name for name in names if isinstance(name, str))
@@ -0,0 +1,789 @@
+# Simplified version of Python readline module that does not require the
+# GNU readline package (which is available only on Linux).
+
+# The line editor: all the state of one readline, so that several can be
+# used at once (e.g. one per socketConsole connection).  Bytes from the
+# terminal go in through addByte(); editing is echoed through writeFn.
+#
+# Editing only changes lineBuf and charPos.  The screen is brought up to
+# date once per batch of input, by render().  The edits note which part of
+# the line they changed, so render() sends just the difference without
+# looking at the rest: a few characters overwritten, inserted (CSI @) or
+# deleted (CSI P), or the end of the line rewritten, whichever is
+# shortest.  Like the cursor movement, this takes
+# it that the line fits on one row of the terminal.  The commonest single
+# keys (a printable one, the arrows, and deleting an ASCII character) with
+# the screen already up to date write their own echo instead, the same
+# bytes render() would have, since render() is most of what they'd cost.
+#
+# The line is UTF-8.  Positions in lineBuf are bytes, but the cursor only
+# ever stops at the start of a character, and the screen is moved and
+# edited by columns, which are counted as characters (wide characters
+# such as CJK are taken to be one column too).  A character whose bytes
+# come in separate reads is held back until it's complete.
+#
+# Incoming escape sequences are decoded with the tables in interpretKeys,
+# one lookup per byte, and nothing kept of them but the state.  Within a
+# read, runs of plain text and whole escape sequences are each taken in
+# one go instead.
+
+import os
+import re
+import functools
+from simpleReadline.interpretKeys import (kBS, kHT, kCtrlG, kCtrlR, kCtrlS,
+        kDEL, kWESC, kGround, kKeySequences, kKeyTables)
+from simpleReadline.history import kBeep, kReturn
+from simpleReadline.gapBuffer import GapBuffer
+from simpleReadline.search import indexFor, Search
+from simpleReadline.complete import Completer
+
+# Editing behavior:
+# - Up and down discard move through the history list.  If a new line is
+#   displayed, any existing changes are discarded.
+# - Left and right move through the current line, and Home and End (or
+#   Ctrl-A and Ctrl-E) to its ends.  Ctrl-Left and Ctrl-Right (or Alt-B
+#   and Alt-F) move a word at a time.
+# - Del and Backspace delete to the left and right of the current position.
+# - Tab completes the name or attribute before the cursor as far as it can
+#   (see complete.py); a second Tab lists what it could be.
+# - Ctrl-R and Ctrl-S search back and forward through the history for what
+#   is typed next (see _searchByte()).
+# - Backtab does nothing.  It's not always available.
+# - Return causes the current line to be processed.
+# - Any other escape sequence is ignored.
+# - Any other key is inserted at the current position.
+# - A HistoryStore drops a line that repeats the one before it; a plain
+#   list keeps it.
+# TODO Should blank lines not be added to history?
+
+# What addBytes() splits its input into.  Group 1 is a run of bytes that
+# are simply inserted: anything but control characters and the Windows
+# escape (which may also start a UTF-8 character, see interpretKeys.kWESC).
+# Group 2 is a whole escape sequence, as the decoder would take it; see
+# interpretKeys.kKeyTables.  Anything else is a byte for the decoder.
+_token = re.compile(rb'(?s)([^\x00-\x1f\x7f\xe0]+)'
+        rb'|(\x1b(?:\[[\x20-\x3f]*[\x40-\x7e]|O[^\x1b]|[^\[O\x1b])'
+        rb'|\xe0[^\x80-\xbf\x1b])|.')
+
+# What word moves stop at: the ends of runs of letters, digits, _ and
+# non-ASCII characters.
+_wordRight = re.compile(rb'[^0-9A-Za-z_\x80-\xff]*[0-9A-Za-z_\x80-\xff]*')
+
+_continuation = bytes(range(0x80, 0xC0))
+_byteStrings = [bytes((bite,)) for bite in range(256)]
+
+class LineEditor:
+
+    __slots__ = (
+        'history',   # list of bytes (or a HistoryStore), [0] is oldest
+        'lineNo',    # index of current line in history
+        'generation',  # the history's generation that lineNo goes by
+        'lineBuf',   # GapBuffer of current line
+        'charPos',   # position within current line
+        'charCol',   # the same in characters
+        'lineCols',  # length of the current line in characters
+        'partial',   # bytearray: the start of a character still coming
+        'escState',  # incoming escape sequence state, see below
+        'writeFn',   # function to write bytes to the terminal; it's
+                     # given a bytearray, which it may keep
+        'output',    # bytearray of output not yet given to writeFn
+        'shownLen',  # length of the line as the screen shows it
+        'shownCols',   # the same in characters
+        'shownPos',  # where the screen's cursor is in the line
+        'shownCol',  # the same in characters
+        'dirtyStart',  # where the line starts to differ from the screen
+        'dirtyCol',    # the same in characters
+        'dirtyTail',   # how many bytes at the end of the line are
+                       # still where the screen shows them (shifted)
+        'context',   # dictionary of identifiers for tab completion
+        'completer',  # complete.Completer for context, made when needed
+        'tabs',      # how many Tabs in a row have just been pressed
+        'prompt',    # bytes of the prompt, to show again after a listing
+        'search',    # search.Search while searching, otherwise None
+        'index',     # search.HistoryIndex, made at the first search
+    )
+
+    # Data invariants:
+    # - history is the history list as (UTF-8) bytes.
+    # - If there's a partial or complete line showing on the screen, it is
+    #   in lineBuf as bytes.
+    # - A line is added to the history list only when Return is pressed and
+    #   it's processed.
+    # - charPos is where the cursor is in lineBuf, at the start of a
+    #   character; charCol is how many characters there are before it.
+    # - lineNo is None if we're on a new line not yet in history.
+    # - lineNo and any search's entry numbers are only good while the
+    #   history's generation is still generation: a HistoryStore shared
+    #   with other editors renumbers its entries when one of them compacts
+    #   it.  See _checkHistory().
+    #
+    # Incoming escape sequence state (escState) is a state of the decoder
+    # in interpretKeys.kKeyTables, kGround when not in an escape sequence.
+
+    def __init__(self, writeFn=None, context=None, history=None):
+        self.history = list() if history is None else history
+        self.lineNo = None
+        self.generation = getattr(self.history, 'generation', 0)
+        self.lineBuf = GapBuffer()
+        self.charPos = 0
+        self.charCol = 0
+        self.lineCols = 0
+        self.partial = bytearray()
+        self.escState = kGround
+        self.writeFn = writeFn
+        self.output = bytearray()
+        self.shownLen = 0
+        self.shownCols = 0
+        self.shownPos = 0
+        self.shownCol = 0
+        self.dirtyStart = None
+        self.dirtyCol = 0
+        self.dirtyTail = 0
+        self.context = context
+        self.completer = None
+        self.tabs = 0
+        self.prompt = b''
+        self.search = None
+        self.index = None
+
+    # Forget the line being edited, e.g. on Ctrl-C, and start again on a
+    # new one (the caller moves the cursor there).  The history is kept.
+    def discard(self):
+        self.lineNo = None
+        self.lineBuf.clear()
+        self.charPos = self.charCol = self.lineCols = 0
+        self.partial.clear()
+        self.escState = kGround
+        self.search = None
+        self._newLine()
+
+    # Some other code hands input text to this function as bytes arrive.
+    # byte is a single byte value (an int), not a bytes object.
+    # Returns None or a full line of text (as a string).
+    # This is _addByte() and flush() inline, since calls are most of what
+    # a key costs, and a printable key is added and echoed here directly
+    # when it can be.
+    def addByte(self, bite):
+        state = self.escState
+        if state == kGround:
+            if self.search is not None:
+                line = self._searchByte(bite)
+                if self.escState == kGround:
+                    self.flush()
+                return line
+            if 32 <= bite < 127:
+                pos = self.charPos
+                if self.dirtyStart is None and pos == self.shownPos and \
+                        not self.partial and not self.output:
+                    # What render() would write: the character, after
+                    # making room for it if it's not at the end.
+                    echo = _byteStrings[bite]
+                    if pos < self.shownLen:
+                        echo = b'\033[@' + echo
+                    self.tabs = 0
+                    self.lineBuf.insertByte(pos, bite)
+                    self.charPos = self.shownPos = pos + 1
+                    self.charCol = self.shownCol = self.charCol + 1
+                    self.lineCols = self.shownCols = self.lineCols + 1
+                    self.shownLen = self.dirtyTail = self.shownLen + 1
+                    self.writeFn(echo)
+                    return None
+            if bite == kHT:
+                self.tabs += 1
+            elif self.tabs:
+                self.tabs = 0
+        action = _dispatch[state][bite]
+        if action.__class__ is int:
+            # Nothing changes part way through an escape sequence.
+            self.escState = action
+            return None
+        self.escState = kGround
+        line = action(self)
+        if self.dirtyStart is not None or self.charPos != self.shownPos:
+            self.render()
+        output = self.output
+        if output:
+            self.output = bytearray()
+            self.writeFn(output)
+        return line
+
+    # Like addByte(), for any number of bytes at once (bytes, bytearray or
+    # memoryview).  Returns a list of the lines completed, and writes all
+    # the echoing in one go.  Runs of plain text, e.g. when something is
+    # pasted, are inserted whole rather than a byte at a time, and escape
+    # sequences are looked up whole.
+    def addBytes(self, buffer):
+        if isinstance(buffer, memoryview):
+            buffer = buffer.tobytes()
+        lines = list()
+        # Whether the tokens can be taken whole, which only a byte through
+        # the decoder can change.
+        whole = self.escState == kGround and self.search is None
+        insert = self.insert
+        actions = _sequenceActions
+        for match in _token.finditer(buffer):
+            kind = match.lastindex
+            if whole and kind is not None:
+                self.tabs = 0
+                if kind == 1:
+                    insert(match[1])
+                else:
+                    action = actions.get(match[2])
+                    if action is not None:
+                        action(self)
+                continue
+            # e.g. a control key, or the rest of a sequence split between
+            # reads
+            for bite in match[0]:
+                line = self._addByte(bite)
+                if line is not None:
+                    lines.append(line)
+            whole = self.escState == kGround and self.search is None
+        self.flush()
+        return lines
+
+    # Give the output collected so far to writeFn, with the screen brought
+    # up to date.
+    def flush(self):
+        if self.dirtyStart is not None or self.charPos != self.shownPos:
+            self.render()
+        output = self.output
+        if output:
+            self.output = bytearray()
+            self.writeFn(output)
+
+    def _addByte(self, bite):
+        state = self.escState
+        if state == kGround:
+            if self.search is not None:
+                return self._searchByte(bite)
+            self.tabs = self.tabs + 1 if bite == kHT else 0
+        action = _dispatch[state][bite]
+        if action.__class__ is int:
+            self.escState = action
+            return None
+        self.escState = kGround
+        return action(self)
+
+    def searchBack(self):
+        self.startSearch(-1)
+
+    def searchForward(self):
+        self.startSearch(1)
+
+    # Start searching the history, back (direction -1) or forward (1).
+    # While searching, the line shows the search and the entry found.
+    def startSearch(self, direction):
+        self._checkHistory()
+        if self.index is None or self.index.history is not self.history:
+            self.index = indexFor(self.history)
+        origin = len(self.history) if self.lineNo is None else self.lineNo
+        self.search = Search(direction, origin + direction,
+                (bytes(self.lineBuf.view()), self.charPos, self.lineNo))
+        self._showSearch()
+
+    # Keys while searching: text is added to what's searched for, Backspace
+    # takes it back off, Ctrl-R and Ctrl-S find the next one, and Ctrl-G
+    # gives up.  Anything else ends the search, with the entry found to
+    # edit, and then does what it usually does.  A character is added once
+    # all its bytes are in.
+    def _searchByte(self, bite):
+        self._checkHistory()
+        search = self.search
+        if bite < 0x80:
+            search.partial.clear()
+        if bite == kCtrlR or bite == kCtrlS:
+            direction = -1 if bite == kCtrlR else 1
+            search.undo.append((search.match, search.failed, 0))
+            search.direction = direction
+            if search.match is not None:
+                self._find(search.match + direction)
+            else:
+                self._find(search.origin)
+        elif bite == kDEL or bite == kBS:
+            if search.undo:
+                search.match, search.failed, typed = search.undo.pop()
+                del search.query[len(search.query) - typed:]
+            else:
+                self.output += kBeep
+        elif bite == kCtrlG:
+            line, charPos, lineNo = search.saved
+            self.search = None
+            self._setLine(line, charPos)
+            self.lineNo = lineNo
+            return None
+        elif bite < 32 or bite == kWESC:
+            self._endSearch()
+            return self._addByte(bite)
+        else:
+            partial = search.partial
+            if partial and bite & 0xC0 != 0x80:
+                partial.clear()
+            partial.append(bite)
+            if _incomplete(partial):
+                return None
+            search.undo.append((search.match, search.failed, len(partial)))
+            search.query += partial
+            partial.clear()
+            if not search.failed:
+                self._find(search.origin if search.match is None else
+                        search.match)
+        self._showSearch()
+        return None
+
+    # If the history has been renumbered since lineNo and the search's
+    # entries were found, forget them (the line itself is kept), so that
+    # they aren't used as numbers in the new history.
+    def _checkHistory(self):
+        generation = getattr(self.history, 'generation', 0)
+        if generation == self.generation:
+            return
+        self.generation = generation
+        self.lineNo = None
+        search = self.search
+        if search is not None:
+            search.match = None
+            search.origin = len(self.history) + search.direction
+            search.undo = [(None, failed, typed)
+                    for match, failed, typed in search.undo]
+            line, charPos, lineNo = search.saved
+            search.saved = (line, charPos, None)
+
+    # Look for the query from entry start on, in the search's direction.
+    def _find(self, start):
+        search = self.search
+        if not search.query:
+            return
+        match = self.index.find(search.query, start, search.direction)
+        if match is None:
+            search.failed = True
+            self.output += kBeep
+        else:
+            search.match = match
+            search.failed = False
+
+    # Put the search and what it found in the line.
+    def _showSearch(self):
+        search = self.search
+        text = bytearray(b'(failed ' if search.failed else b'(')
+        text += b'reverse-i-search)`' if search.direction < 0 else \
+                b'i-search)`'
+        text += search.query
+        text += b"': "
+        if search.match is None:
+            entry = search.saved[0]
+            at = search.saved[1]
+        else:
+            entry = self.history[search.match]
+            at = _matchAt(entry, search.query)
+        self._setLine(text + entry, len(text) + at)
+
+    # Stop searching, with what was found to edit.
+    def _endSearch(self):
+        search = self.search
+        self.search = None
+        if search.match is None:
+            line, charPos, lineNo = search.saved
+        else:
+            line = self.history[search.match]
+            charPos = _matchAt(line, search.query)
+            lineNo = search.match
+        self._setLine(line, charPos)
+        self.lineNo = lineNo
+
+    # Replace the line with data, with the cursor at pos.
+    def _setLine(self, data, pos):
+        self.lineBuf.set(data)
+        self.charPos = pos
+        self.charCol = _chars(data[:pos])
+        self.lineCols = _chars(data)
+        self.partial.clear()
+        self._changed(0, 0, 0)
+
+    # Note that the line has changed from pos (character col) on, except
+    # for its last keep bytes.
+    def _changed(self, pos, keep, col):
+        if self.dirtyStart is None or pos < self.dirtyStart:
+            self.dirtyStart = pos
+            self.dirtyCol = col
+        if keep < self.dirtyTail:
+            self.dirtyTail = keep
+
+    # The screen is now on a new, empty line.
+    def _newLine(self):
+        self.shownLen = self.shownPos = 0
+        self.shownCols = self.shownCol = 0
+        self.dirtyStart = None
+        self.dirtyTail = 0
+
+    # Add to output what it takes to make the screen show lineBuf with the
+    # cursor at charPos.
+    def render(self):
+        line = self.lineBuf
+        newPos = self.charPos
+        newCol = self.charCol
+        start = self.dirtyStart
+        if start is None:
+            if newPos != self.shownPos:
+                self.output += self._move(self.shownPos, self.shownCol,
+                        newPos, newCol)
+                self.shownPos = newPos
+                self.shownCol = newCol
+            return
+        length = len(line)
+        if start == self.shownPos == self.shownLen and newPos == length:
+            # Typing at the end of the line, the usual case: just echo it.
+            self.output += line.slice(start, length)
+            self.shownLen = self.shownPos = length
+            self.shownCols = self.shownCol = newCol
+            self.dirtyStart = None
+            self.dirtyTail = length
+            return
+        # The tail is on the screen already, only the old middle needs to
+        # be made into the new one.  The tail is as many characters as it
+        # was, which says how many the old middle had.
+        tail = min(self.dirtyTail, length - start, self.shownLen - start)
+        middle = line.slice(start, length - tail)
+        startCol = self.dirtyCol
+        cols = _chars(middle)
+        oldCols = cols + self.shownCols - self.lineCols
+        output = self._move(self.shownPos, self.shownCol, start, startCol)
+        # Overwrite what's in both, then insert or delete the rest, which
+        # moves the tail along...
+        common = min(cols, oldCols)
+        split = common if cols == len(middle) else _charOffset(middle, common)
+        edit = bytearray(middle[:split])
+        if cols > oldCols:
+            if tail:
+                edit += _csi(cols - oldCols, b'@')
+            edit += middle[split:]
+        elif cols < oldCols:
+            edit += _csi(oldCols - cols, b'P')
+        editEnd = start + len(middle)
+        self.shownLen = length
+        self.shownCols = self.lineCols
+        self.dirtyStart = None
+        self.dirtyTail = length
+        edit += self._move(editEnd, startCol + cols, newPos, newCol)
+        # ...unless it's shorter to rewrite the tail as well.
+        if tail and length - start + 3 < len(edit):
+            rewrite = line.slice(start, length)
+            if cols < oldCols:
+                rewrite += b'\033[K'
+            rewrite += self._move(length, self.lineCols, newPos, newCol)
+            if len(rewrite) < len(edit):
+                edit = rewrite
+        output += edit
+        self.output += output
+        self.shownPos = newPos
+        self.shownCol = newCol
+
+    # The output to move the cursor from position at (column atCol) to
+    # newPos (newCol), once the screen is up to date.  Short moves right
+    # write the characters already there instead of an escape sequence.
+    def _move(self, at, atCol, newPos, newCol):
+        if newCol < atCol:
+            n = atCol - newCol
+            return b'\b' * n if n <= 3 else _csi(n, b'D')
+        if newCol > atCol:
+            n = newCol - atCol
+            return self.lineBuf.slice(at, newPos) if n <= 3 else \
+                    _csi(n, b'C')
+        return b''
+
+    def enter(self):
+        self.render()
+        result = self.lineBuf.decode()
+        self.history.append(bytes(self.lineBuf.view()))
+        if self.index is not None:
+            self.index.update()
+        self.lineNo = None
+        self.lineBuf.clear()
+        self.charPos = self.charCol = self.lineCols = 0
+        self.partial.clear()
+        self.output += kReturn
+        self._newLine()
+        return result
+
+    # Where there are as many characters as bytes (charCol == charPos
+    # before the cursor, say), they're all ASCII, and the cursor moves a
+    # byte at a time without looking at them.  If the screen is up to date
+    # (dirtyStart is None and shownPos is the cursor) its echo is written
+    # here too.
+
+    def left(self):
+        pos = self.charPos
+        if pos == self.charCol and pos > 0:
+            self.charPos = self.charCol = pos - 1
+            if pos == self.shownPos and self.dirtyStart is None:
+                self.output += b'\b'
+                self.shownPos = self.shownCol = pos - 1
+        elif pos > 0:
+            data = self.lineBuf.slice(max(0, pos - 4), pos)
+            i = len(data) - 1
+            while i > 0 and data[i] & 0xC0 == 0x80:
+                i -= 1
+            self.charPos = pos - (len(data) - i)
+            if data[i] & 0xC0 != 0x80:
+                self.charCol -= 1
+        else:
+            self.output += kBeep
+
+    def right(self):
+        pos = self.charPos
+        if pos == self.shownPos and self.dirtyStart is None and \
+                pos < self.shownLen and \
+                self.shownLen - pos == self.shownCols - self.shownCol:
+            # The screen is up to date, and from here on the line is ASCII:
+            # what render() would write is the character that's there.
+            self.output.append(self.lineBuf.byteAt(pos))
+            self.charPos = self.shownPos = pos + 1
+            self.charCol = self.shownCol = self.charCol + 1
+            return
+        length = len(self.lineBuf)
+        if length - pos == self.lineCols - self.charCol and pos < length:
+            self.charPos = pos + 1
+            self.charCol += 1
+        elif pos < length:
+            self.charPos = end = self._charAfter(pos)
+            self.charCol += _chars(self.lineBuf.slice(pos, end))
+        else:
+            self.output += kBeep
+
+    def home(self):
+        self.charPos = self.charCol = 0
+
+    def end(self):
+        self.charPos = len(self.lineBuf)
+        self.charCol = self.lineCols
+
+    def wordLeft(self):
+        before = self.lineBuf.slice(0, self.charPos)
+        before.reverse()
+        self._moveTo(self.charPos - _wordRight.match(before).end())
+
+    def wordRight(self):
+        after = self.lineBuf.slice(self.charPos, len(self.lineBuf))
+        self._moveTo(self.charPos + _wordRight.match(after).end())
+
+    # Move the cursor to pos, keeping count of the characters.
+    def _moveTo(self, pos):
+        if pos < self.charPos:
+            self.charCol -= _chars(self.lineBuf.slice(pos, self.charPos))
+        else:
+            self.charCol += _chars(self.lineBuf.slice(self.charPos, pos))
+        self.charPos = pos
+
+    # Where the character at pos ends.
+    def _charAfter(self, pos):
+        data = self.lineBuf.slice(pos, min(len(self.lineBuf), pos + 4))
+        i = 1
+        while i < len(data) and data[i] & 0xC0 == 0x80:
+            i += 1
+        return pos + i
+
+    def up(self):
+        self._checkHistory()
+        history = self.history
+        if self.lineNo is None:
+            if history:
+                new = len(history) - 1
+            else:
+                new = None
+        elif self.lineNo > 0:
+            new = self.lineNo - 1
+        else:
+            new = 0
+        # If new is None then we have no history; do nothing.  And lineNo
+        # is necessarily also None.
+        if new != self.lineNo:
+            line = history[new]
+            self._setLine(line, len(line))
+            self.lineNo = new
+        else:
+            self.output += kBeep
+
+    def down(self):
+        self._checkHistory()
+        if self.lineNo is None:
+            new = None
+        else:
+            new = self.lineNo + 1
+            if new >= len(self.history):
+                new = None
+        # If new is None then we are on a new blank line
+        if new != self.lineNo:
+            line = b'' if new is None else self.history[new]
+            self._setLine(line, len(line))
+            self.lineNo = new
+        else:
+            self.output += kBeep
+
+    def delLeft(self):
+        pos = self.charPos
+        if pos == self.charCol and pos > 0:
+            self.lineBuf.delete(pos - 1)
+            self.charPos = self.charCol = pos - 1
+            self.lineCols -= 1
+            if pos == self.shownPos and self.dirtyStart is None:
+                # What render() would write: back one, delete a character.
+                self.output += b'\b\033[P'
+                self.shownPos = self.shownCol = pos - 1
+                self.shownCols = self.lineCols
+                self.shownLen = self.dirtyTail = len(self.lineBuf)
+            else:
+                self._changed(pos - 1, len(self.lineBuf) - pos + 1, pos - 1)
+        elif pos > 0:
+            end = pos
+            self.left()
+            self._delete(end)
+        else:
+            self.output += kBeep
+
+    def delRight(self):
+        pos = self.charPos
+        length = len(self.lineBuf)
+        if length - pos == self.lineCols - self.charCol and pos < length:
+            self.lineBuf.delete(pos)
+            self.lineCols -= 1
+            if pos == self.shownPos and self.dirtyStart is None:
+                self.output += b'\033[P'
+                self.shownCols = self.lineCols
+                self.shownLen = self.dirtyTail = length - 1
+            else:
+                self._changed(pos, length - 1 - pos, self.charCol)
+        elif pos < length:
+            self._delete(self._charAfter(pos))
+        else:
+            self.output += kBeep
+
+    # Delete from the cursor to end.
+    def _delete(self, end):
+        pos = self.charPos
+        self.lineCols -= _chars(self.lineBuf.slice(pos, end))
+        self.lineBuf.delete(pos, end - pos)
+        self._changed(pos, len(self.lineBuf) - pos, self.charCol)
+
+    # Insert bites (bytes or bytearray) at the cursor.  If they end part
+    # way through a character, the rest of it is waited for.
+    def insert(self, bites):
+        partial = self.partial
+        if partial:
+            if bites and bites[0] & 0xC0 == 0x80:
+                bites = partial + bites
+            partial.clear()
+        if bites.isascii():
+            cols = len(bites)
+        else:
+            cut = _incomplete(bites)
+            if cut:
+                partial += bites[-cut:]
+                bites = bites[:-cut]
+                if not bites:
+                    return
+            cols = _chars(bites)
+        pos = self.charPos
+        self.lineBuf.insert(pos, bites)
+        self._changed(pos, len(self.lineBuf) - pos - len(bites), self.charCol)
+        self.charPos = pos + len(bites)
+        self.charCol += cols
+        self.lineCols += cols
+
+    # Complete the word before the cursor as far as all the candidates
+    # agree.  If that adds nothing, the second Tab lists them.
+    def expand(self):
+        completer = self.completer
+        if completer is None or completer.context is not self.context:
+            completer = self.completer = Completer(self.context)
+        text = self.lineBuf.slice(0, self.charPos).decode('utf-8', 'replace')
+        prefix, candidates = completer.complete(text)
+        common = os.path.commonprefix(candidates)
+        if len(common) > len(prefix):
+            self.insert(common[len(prefix):].encode())
+        elif len(candidates) > 1 and self.tabs > 1:
+            self._list(candidates)
+        else:
+            self.output += kBeep
+
+    # Show names in columns below the line, then the prompt and the line
+    # again.  The terminal is taken to be 80 columns wide.
+    def _list(self, names):
+        names = sorted(names)
+        self.render()
+        self.output += self._move(self.shownPos, self.shownCol,
+                self.shownLen, self.shownCols)
+        width = max(len(name) for name in names) + 2
+        columns = max(1, 80 // width)
+        rows = (len(names) + columns - 1) // columns
+        for row in range(rows):
+            self.output += kReturn
+            self.output += ''.join(name.ljust(width)
+                    for name in names[row::rows]).rstrip().encode()
+        self.output += kReturn
+        self.output += self.prompt
+        self._newLine()
+        self._changed(0, 0, 0)
+
+# A CSI sequence with count n; 1 is the default, so it's left out.
+def _csi(n, final):
+    if n == 1:
+        return b'\033[' + final
+    return b'\033[%d' % n + final
+
+# How many characters the UTF-8 in data (bytes or bytearray) is.
+def _chars(data):
+    if data.isascii():
+        return len(data)
+    return len(data.translate(None, _continuation))
+
+# Where in data (UTF-8) the character after the first n starts.
+def _charOffset(data, n):
+    for i, bite in enumerate(data):
+        if bite & 0xC0 != 0x80:
+            if n == 0:
+                return i
+            n -= 1
+    return len(data)
+
+# Where the search query is in the entry it matched.  If more has been
+# typed since, and not found, that's where as much of it as was found is.
+def _matchAt(entry, query):
+    for n in range(len(query), 0, -1):
+        at = entry.find(query[:n])
+        if at >= 0:
+            return at
+    return 0
+
+# How many bytes at the end of data are an incomplete character.
+def _incomplete(data):
+    n = len(data)
+    for i in range(1, min(n, 3) + 1):
+        bite = data[n - i]
+        if bite < 0x80:
+            return 0
+        if bite >= 0xC0:
+            need = 2 if bite < 0xE0 else 3 if bite < 0xF0 else 4
+            return i if i < need else 0
+    return 0
+
+# kKeyTables and kKeySequences, with the names made into functions of
+# the editor.
+def _action(name, bite):
+    if name.__class__ is int:
+        return name
+    if name == '_ignore':
+        return _ignore
+    if name == '_insertByte':
+        return functools.partial(LineEditor.insert, bites=_byteStrings[bite])
+    if name == '_windowsUtf8':
+        return functools.partial(LineEditor.insert,
+                bites=bytes((kWESC, bite)))
+    return getattr(LineEditor, name)
+
+def _ignore(editor):
+    pass
+
+_dispatch = tuple(tuple(_action(name, bite) for bite, name in enumerate(table))
+        for table in kKeyTables)
+_sequenceActions = {sequence: getattr(LineEditor, name)
+        for sequence, name in kKeySequences.items()}
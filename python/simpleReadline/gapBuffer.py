@@ -0,0 +1,114 @@
+# Simplified version of Python readline module that does not require the
+# GNU readline package (which is available only on Linux).
+
+# The line being edited, as a gap buffer: the bytes are kept in one
+# bytearray with a gap in it at the place last edited.  Typing or deleting
+# there only moves the edges of the gap, instead of shifting the rest of
+# the line along every time; moving the gap costs only the distance moved.
+# view() gives the contents as a memoryview without copying them.
+
+class GapBuffer:
+
+    __slots__ = (
+        'buf',       # bytearray: the contents, with the gap in the middle
+        'gapStart',  # index in buf of the start of the gap
+        'gapEnd',    # index in buf just past the gap
+    )
+
+    def __init__(self, data=b'', capacity=64):
+        n = len(data)
+        self.buf = bytearray(max(capacity, 2 * n))
+        self.buf[:n] = data
+        self.gapStart = n
+        self.gapEnd = len(self.buf)
+
+    def __len__(self):
+        return len(self.buf) - (self.gapEnd - self.gapStart)
+
+    # Insert data (bytes, bytearray, memoryview or byte values) at pos.
+    def insert(self, pos, data):
+        n = len(data)
+        if n > self.gapEnd - self.gapStart:
+            self._grow(n)
+        self._moveGap(pos)
+        self.buf[self.gapStart:self.gapStart + n] = data
+        self.gapStart += n
+
+    # Insert one byte value (an int) at pos; much cheaper than insert() for
+    # a key at a time.
+    def insertByte(self, pos, bite):
+        if pos != self.gapStart:
+            self._moveGap(pos)
+        if self.gapStart == self.gapEnd:
+            self._grow(1)
+        self.buf[self.gapStart] = bite
+        self.gapStart += 1
+
+    # The byte value (an int) at pos.
+    def byteAt(self, pos):
+        if pos >= self.gapStart:
+            pos += self.gapEnd - self.gapStart
+        return self.buf[pos]
+
+    # Delete n bytes from pos on.
+    def delete(self, pos, n=1):
+        self._moveGap(pos)
+        self.gapEnd += n
+
+    def clear(self):
+        self.gapStart = 0
+        self.gapEnd = len(self.buf)
+
+    # Replace the contents with data.
+    def set(self, data):
+        self.clear()
+        self.insert(0, data)
+
+    # A copy of bytes start to end of the contents, which leaves the gap
+    # where it is.
+    def slice(self, start, end):
+        buf = self.buf
+        gapStart = self.gapStart
+        gapSize = self.gapEnd - gapStart
+        if end <= gapStart:
+            return buf[start:end]
+        if start >= gapStart:
+            return buf[start + gapSize:end + gapSize]
+        return buf[start:gapStart] + buf[self.gapEnd:end + gapSize]
+
+    # The contents as a memoryview into the buffer, which is good until the
+    # next change.  Moves the gap to the end, if it isn't there already.
+    def view(self):
+        self._moveGap(len(self))
+        return memoryview(self.buf)[:self.gapStart]
+
+    def decode(self):
+        return str(self.view(), 'utf-8', 'replace')
+
+    def _moveGap(self, pos):
+        buf = self.buf
+        start = self.gapStart
+        end = self.gapEnd
+        if pos < start:
+            n = start - pos
+            buf[end - n:end] = buf[pos:start]
+            self.gapStart = pos
+            self.gapEnd = end - n
+        elif pos > start:
+            n = pos - start
+            buf[start:pos] = buf[end:end + n]
+            self.gapStart = pos
+            self.gapEnd = end + n
+
+    # Make the gap at least need bytes.  This makes a new bytearray rather
+    # than resizing the old one, which can't be done while a view() of it
+    # is still around.
+    def _grow(self, need):
+        old = self.buf
+        size = max(2 * len(old), len(old) + need)
+        tail = len(old) - self.gapEnd
+        buf = bytearray(size)
+        buf[:self.gapStart] = old[:self.gapStart]
+        buf[size - tail:] = old[self.gapEnd:]
+        self.buf = buf
+        self.gapEnd = size - tail
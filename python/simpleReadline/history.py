@@ -1,170 +1,199 @@
 # Simplified version of Python readline module that does not require the
 # GNU readline package (which is available only on Linux).
 
-# Manage the history state and changes including editing the current line.
-# Also echoes back to the screen.
-
+# Module-level editing functions and the file-backed history.
+# The editing state and the editing itself are in editor.LineEditor; the
+# functions here act on the module's default editor (main.editor).
+# HistoryStore keeps the history list in a file, across sessions.
+
+import os
+import mmap
+import struct
 import simpleReadline as sr
 
-# Behavior:
-# - Up and down discard move through the history list.  If a new line is
-#   displayed, any existing changes are discarded.
-# - Left and right move through the current line.
-# - Del and Backspace delete to the left and right of the current position.
-# - Tab does expansion (see elsewhere).  TODO
-# - Backtab does nothing.  It's not always available.
-# - Return causes the current line to be processed.
-# - Any other escape sequence is ignored.
-# - Any other key is inserted at the current position.
-# TODO Should blank lines and repeats not be added to history?
-
-_history = list()   # list of strings, [0] is oldest
-_lineNo = None      # index of current line in _history
-_lineBuf = None     # bytearray of current line
-_charPos = None     # position within current line
-
-# Data invariants:
-# - _history is the history list as (Unicode) strings.
-# - If there's a partial or complete line showing on the screen, it is
-#   in _lineBuf as bytes.
-# - A line is added to the history list only when Return is pressed and
-#   it's processed.
-# - If _lineBuf is not None then _charPos is valid.  If _lineBuf is None,
-#   then we're at the beginning of a blank line.
-# - _lineNo is None if we're on a new line not yet in history.
-
 # Some output sequences as bytes
 kBeep = b'\a'
-kErase = b'\b \b'
 kReturn = b'\r\n'
-kLeft = b'\033[D'
-kRight = b'\033[C'
-kEraseLine = b'\033[0E\033[J'
-
-# Rewrite the tail of the line.  The cursor is currently at _charPos,
-# and _lineBuf[start:] has (potentially) changed.  Leave cursor at newPos.
-# Note _lineBuf may not be None when this is called.
-def _rewrite(start, newPos):
-    global _lineBuf, _charPos
-    command = bytearray()
-    # Move cursor to start
-    if _charPos is None:
-        # We must be at the beginning of a blank line.
-        # Remember _lineBuf has been updated but _charPos has not.
-        _charPos = 0
-    _cmdMove(command, start - _charPos)
-    # Erase to end of line (end of screen, actually)
-    command.extend(b'\033[J')
-    # Write new data
-    command.extend(_lineBuf[start:])
-    # Move cursor to newPos
-    _cmdMove(command, newPos - len(_lineBuf))
-    sr.main._writeFn(command)
-    _charPos = newPos
-
-# Append escape sequence to command, to move right n spaces.
-# Append nothing if n is zero; negative n means move left.
-def _cmdMove(command, n):
-    if n < 0:
-        command.extend(b'\033[')
-        command.extend(str(-n).encode())
-        command.extend(b'D')
-    elif n > 0:
-        command.extend(b'\033[')
-        command.extend(str(n).encode())
-        command.extend(b'C')
 
-def enter():
-    global _lineBuf, _lineNo
-    if _lineBuf is not None:
-        result = _lineBuf.decode()
-    else:
-        result = ""
-    _lineNo = _lineBuf = None
-    _history.append(result)
-    sr.main._writeFn(kReturn)
+# Run an editing method on the default editor and write what it echoes.
+def _edit(method, *args):
+    editor = sr.main.editor
+    result = method(editor, *args)
+    editor.flush()
     return result
 
+def enter():
+    return _edit(sr.LineEditor.enter)
+
 def left():
-    global _lineBuf, _lineNo, _charPos
-    if _lineBuf and _charPos > 0:
-        _charPos += -1
-        sr.main._writeFn(kLeft)
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.left)
 
 def right():
-    global _lineBuf, _lineNo, _charPos
-    if _lineBuf and _charPos < len(_lineBuf):
-        _charPos += 1
-        sr.main._writeFn(kRight)
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.right)
 
 def up():
-    global _lineBuf, _lineNo, _charPos
-    if _lineNo is None:
-        if _history:
-            new = len(_history) - 1
-        else:
-            new = None
-    elif _lineNo > 0:
-        new = _lineNo - 1
-    else:
-        new = 0
-    # If new is None then we have no history; do nothing.  And _lineNo
-    # is necessarily also None.
-    if new != _lineNo:
-        _lineBuf = bytearray(_history[new].encode())
-        _rewrite(0, len(_lineBuf))
-        _lineNo = new
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.up)
 
 def down():
-    global _lineBuf, _lineNo, _charPos
-    if _lineNo is None:
-        new = None
-    else:
-        new = _lineNo + 1
-        if new >= len(_history):
-            new = None
-    # If new is None then we are on a new blank line
-    if new != _lineNo:
-        if new is None:
-            _lineBuf = bytearray()
-        else:
-            _lineBuf = bytearray(_history[new].encode())
-        _rewrite(0, len(_lineBuf))
-        _lineNo = new
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.down)
 
 def delLeft():
-    global _lineBuf, _charPos
-    if _lineBuf and _charPos > 0:
-        newPos = _charPos - 1
-        del _lineBuf[newPos]
-        _rewrite(newPos, newPos)
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.delLeft)
 
 def delRight():
-    global _lineBuf, _charPos
-    if _lineBuf and _charPos < len(_lineBuf):
-        del _lineBuf[_charPos]
-        _rewrite(_charPos, _charPos)
-    else:
-        sr.main._writeFn(kBeep)
+    _edit(sr.LineEditor.delRight)
 
 def insert(bite):
-    global _lineBuf, _charPos
-    if _lineBuf is None:
-        _lineBuf = bytearray()
-        _charPos = 0
-    _lineBuf.insert(_charPos, bite)
-    _rewrite(_charPos, _charPos + 1)
+    _edit(sr.LineEditor.insert, bytes((bite,)))
 
 def expand():
-    print("expand", end='\r\n')
-
+    _edit(sr.LineEditor.expand)
+
+# A history kept in a file, which can be used wherever the editor's
+# history list can.  The file is a header and then the entries, each
+# written as its length, its bytes and its length again:
+#     header:  magic (8 bytes), end of the entries (u64), count (u32), pad
+#     entry:   n (u32), n bytes of UTF-8, n (u32)
+# The file is memory mapped, and only the end of it is looked at to start
+# with; entries are found from the newest back, as Up asks for them.  An
+# entry counts once the header says so, so a partly written one is just
+# ignored.  When there are more than maxEntries entries or maxBytes bytes
+# of them (None is no limit), the file is rewritten with the newest three
+# quarters.  Only one process at a time should use a file.
+
+kHistoryMagic = b'srHist1\n'
+_header = struct.Struct('<8sQI4x')
+_length = struct.Struct('<I')
+_kInitialSize = 1 << 16
+
+class HistoryStore:
+
+    __slots__ = (
+        'path',
+        'maxEntries',
+        'maxBytes',
+        'file',      # the open file
+        'map',       # mmap of the whole file
+        'end',       # offset just past the last entry
+        'count',     # number of entries
+        'base',      # count when the file was opened
+        'back',      # back[k] is where entry base - 1 - k starts
+        'forward',   # forward[j] is where entry base + j starts
+        'generation',  # how many times the entries have been renumbered
+        'index',     # search.HistoryIndex of it, made when first needed
+    )
+
+    def __init__(self, path, maxEntries=10000, maxBytes=4 << 20):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.generation = 0
+        self.index = None
+        self._open()
+
+    def _open(self):
+        # The history may well have passwords in it.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.file = open(fd, 'r+b')
+        size = os.fstat(fd).st_size
+        if size == 0:
+            self.file.write(_header.pack(kHistoryMagic, _header.size, 0))
+            self.file.truncate(_kInitialSize)
+            size = _kInitialSize
+        magic = None
+        if size >= _header.size:
+            self.map = mmap.mmap(self.file.fileno(), size)
+            magic, self.end, self.count = _header.unpack_from(self.map)
+        if magic != kHistoryMagic or not _header.size <= self.end <= size:
+            if magic is not None:
+                self.map.close()
+            self.file.close()
+            raise ValueError('{} is not a simpleReadline history file'
+                    .format(self.path))
+        self.base = self.count
+        self.back = list()
+        self.forward = list()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('history index out of range')
+        if i >= self.base:
+            start = self.forward[i - self.base]
+        else:
+            k = self.base - 1 - i
+            back = self.back
+            while len(back) <= k:
+                pos = back[-1] if back else (self.forward[0] if
+                        self.forward else self.end)
+                n, = _length.unpack_from(self.map, pos - _length.size)
+                back.append(pos - n - 2 * _length.size)
+            start = back[k]
+        n, = _length.unpack_from(self.map, start)
+        start += _length.size
+        return self.map[start:start + n]
+
+    # Add entry (bytes) as the newest, unless it's the same as the newest.
+    def append(self, entry):
+        if self.count and self[-1] == entry:
+            return
+        n = len(entry)
+        start = self.end
+        end = start + n + 2 * _length.size
+        if end > len(self.map):
+            self._grow(end)
+        _length.pack_into(self.map, start, n)
+        self.map[start + _length.size:end - _length.size] = entry
+        _length.pack_into(self.map, end - _length.size, n)
+        self.forward.append(start)
+        self.end = end
+        self.count += 1
+        _header.pack_into(self.map, 0, kHistoryMagic, self.end, self.count)
+        if (self.maxEntries is not None and self.count > self.maxEntries) or \
+                (self.maxBytes is not None and
+                        self.end - _header.size > self.maxBytes):
+            self._compact()
+
+    # Make the file (and the map) at least size bytes.
+    def _grow(self, size):
+        size = max(size, 2 * len(self.map))
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    # Rewrite the file with just the newest entries, and switch to it.
+    def _compact(self):
+        maxEntries = self.count if self.maxEntries is None else \
+                self.maxEntries * 3 // 4
+        maxBytes = self.end if self.maxBytes is None else \
+                self.maxBytes * 3 // 4
+        keep = list()
+        size = 0
+        for i in range(self.count - 1, -1, -1):
+            entry = self[i]
+            if len(keep) >= maxEntries or \
+                    size + len(entry) + 2 * _length.size > maxBytes:
+                break
+            keep.append(entry)
+            size += len(entry) + 2 * _length.size
+        temp = self.path + '.tmp'
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'wb') as f:
+            f.write(_header.pack(kHistoryMagic, _header.size + size,
+                    len(keep)))
+            for entry in reversed(keep):
+                f.write(_length.pack(len(entry)))
+                f.write(entry)
+                f.write(_length.pack(len(entry)))
+        self.close()
+        os.replace(temp, self.path)
+        self._open()
+        self.generation += 1
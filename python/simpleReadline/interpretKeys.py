@@ -22,105 +22,126 @@ kLEFT = ord('D')
 kRIGHT = ord('C')
 kDOWN = ord('B')
 kDELKEY = ord('~')
+kHOME = ord('H')
+kEND = ord('F')
+kCtrlA = 1
+kCtrlE = 5
+kCtrlG = 7   # same as kBEL
+kCtrlR = 18
+kCtrlS = 19
 
 # Windows console, determined by experimentation.  I made up the names.
+# A Windows key could also be a UTF-8 character starting with 0xE0, which
+# is told apart by what comes next: continuation bytes are 0x80-0xBF.
 kWESC = 224  # Used like ESC on Windows
 kWUP = 72
 kWLEFT = 75
 kWRIGHT = 77
 kWDOWN = 80
 kWDEL = 83
+kWHOME = 71
+kWEND = 79
+kWCtrlLEFT = 115
+kWCtrlRIGHT = 116
 
-# Incoming escape sequence state
-# None - not in an escape sequence
-# True - ESC received
-# (int) - alternate state, e.g. ESC-O
-# (bytearray) - reading a CSI code
-_escState = None
+# The editing keys, by the escape sequences terminals send for them, as
+# names of editor.LineEditor methods.  xterm adds modifiers as a second
+# parameter, 1 plus 1 for Shift, 2 for Alt and 4 for Ctrl, e.g. ESC [ 1 ; 5
+# D is Ctrl-Left.
+kKeySequences = dict()
+
+def _addKeys():
+    keys = kKeySequences
+    for final, name, word in ((kUP, 'up', 'up'), (kDOWN, 'down', 'down'),
+            (kLEFT, 'left', 'wordLeft'), (kRIGHT, 'right', 'wordRight'),
+            (kHOME, 'home', 'home'), (kEND, 'end', 'end')):
+        keys[bytes((kESC, kCSI, final))] = name
+        keys[bytes((kESC, kSS3, final))] = name
+        for modifiers in range(1, 8):
+            keys[b'\033[1;%d%c' % (modifiers + 1, final)] = \
+                    word if modifiers & 6 else name
+    for n, name in ((1, 'home'), (7, 'home'), (4, 'end'), (8, 'end'),
+            (3, 'delRight')):
+        keys[b'\033[%d~' % n] = name
+        for modifiers in range(1, 8):
+            keys[b'\033[%d;%d~' % (n, modifiers + 1)] = name
+    keys[b'\033Od'] = 'wordLeft'    # rxvt Ctrl-Left and Ctrl-Right
+    keys[b'\033Oc'] = 'wordRight'
+    keys[b'\033b'] = 'wordLeft'     # Alt-B and Alt-F
+    keys[b'\033f'] = 'wordRight'
+    for code, name in ((kWUP, 'up'), (kWDOWN, 'down'), (kWLEFT, 'left'),
+            (kWRIGHT, 'right'), (kWHOME, 'home'), (kWEND, 'end'),
+            (kWCtrlLEFT, 'wordLeft'), (kWCtrlRIGHT, 'wordRight'),
+            (kWDEL, 'delRight')):
+        keys[bytes((kWESC, code))] = name
+
+_addKeys()
+
+# The single bytes that aren't just inserted.
+kControlKeys = {kCR: 'enter', kLF: 'enter', kDEL: 'delLeft', kBS: 'delLeft',
+        kHT: 'expand', kCtrlA: 'home', kCtrlE: 'end',
+        kCtrlR: 'searchBack', kCtrlS: 'searchForward'}
+
+# kKeySequences compiled into a state machine, so a sequence can be
+# decoded a byte at a time (as it may well arrive) without keeping any of
+# it.  There is a state for each beginning of a sequence, and one for the
+# rest of an unknown CSI sequence.  kKeyTables[state][byte] is the next
+# state (an int), or else the name of the method to call, after which the
+# decoder is back in kGround.  The names that start with _ are the
+# decoder's own: _insertByte inserts the byte, _windowsUtf8 inserts 0xE0
+# and the byte, and _ignore does nothing.  Anything unknown is ignored, as
+# far as the end of its sequence: CSI parameters are bytes 0x20-0x3F and
+# the final byte is 0x40-0x7E.
+kGround = 0
+
+def _compile():
+    states = {b'': kGround}
+    for sequence in sorted(kKeySequences):
+        for i in range(1, len(sequence)):
+            states.setdefault(sequence[:i], len(states))
+    skipCsi = len(states)
+    escape = states[bytes((kESC,))]
+    tables = list()
+    for prefix in states:
+        if prefix == b'':
+            table = ['_insertByte'] * 256
+            table[:32] = ['_ignore'] * 32
+            for bite, name in kControlKeys.items():
+                table[bite] = name
+        elif prefix.startswith(bytes((kESC, kCSI))):
+            table = ['_ignore'] * 256
+            table[0x20:0x40] = [skipCsi] * 0x20
+        elif prefix == bytes((kWESC,)):
+            # A continuation byte next means it's UTF-8 after all.
+            table = ['_ignore'] * 256
+            table[0x80:0xC0] = ['_windowsUtf8'] * 0x40
+        else:
+            table = ['_ignore'] * 256
+        table[kESC] = escape
+        for bite in range(256):
+            longer = prefix + bytes((bite,))
+            if longer in states:
+                table[bite] = states[longer]
+            elif longer in kKeySequences:
+                table[bite] = kKeySequences[longer]
+        tables.append(tuple(table))
+    table = ['_ignore'] * 256
+    table[0x20:0x40] = [skipCsi] * 0x20
+    table[kESC] = escape
+    tables.append(tuple(table))
+    return tuple(tables)
+
+kKeyTables = _compile()
 
 # Some other code hands input text to this function as bytes arrive.
 # byte is a single byte value (an int), not a bytes object.
 # Returns None or a full line of text (as a string).
+# The escape sequence state and the editing are in editor.LineEditor; this
+# acts on the module's default editor (main.editor).
 def addByte(bite):
-    global _escState
-    #print('addByte():', bite, end='\r\n')
-    #print('_escState is', _escState, end='\r\n')
-    if _escState is not None:
-        return _handleEsc(bite)
-    global _writeFn
-    if bite == kCR or bite == kLF:
-        return sr.history.enter()
-    elif bite == kDEL or bite == kBS:
-        return sr.history.delLeft()
-    elif bite == kHT:
-        return sr.history.expand()
-    elif bite == kESC:
-        _escState = True
-    elif bite == kWESC:
-        _escState = kWESC
-    else:
-        sr.history.insert(bite)
-    return None
-
-def _handleEsc(bite):
-    global _escState
-    #print("_handleEsc(", bite, ")", end='\r\n')
-    if _escState is True:
-        if bite == kCSI:
-            _escState = bytearray()
-            #print('parsed CSI', end='\r\n')
-        elif kSS2 <= bite <= kSS3:
-            _escState = bite;
-        elif 64 <= bite <= 95:   # two-character sequence
-            _escState = None
-            # TODO deal with sequence
-            print('ESC-', chr(bite), end='\r\n')
-        else:
-            print('bad escape sequence:', kESC, bite, end='\r\n')
-            _escState = None
-    elif _escState is kWESC:
-        if bite == kWUP:
-            sr.history.up()
-        elif bite == kWDOWN:
-            sr.history.down()
-        elif bite == kWLEFT:
-            sr.history.left()
-        elif bite == kWRIGHT:
-            sr.history.right()
-        elif bite == kWDEL:
-            sr.history.delRight()
-        else:
-            print('Bad or unused Windows ESC-', bite, end='\r\n')
-        _escState = None
-    elif isinstance(_escState, bytearray):
-        #print('within a CSI', end='\r\n')
-        if 48 <= bite <= 63:
-            _escState.append(bite)
-        elif 64 <= bite <= 126:  # end of CSI sequence
-            if bite == kUP:
-                sr.history.up()
-            elif bite == kDOWN:
-                sr.history.down()
-            elif bite == kLEFT:
-                sr.history.left()
-            elif bite == kRIGHT:
-                sr.history.right()
-            elif bite == kDELKEY and _escState == b'3':
-                sr.history.delRight()
-            else:
-                print('unused or unknown ESC-',
-                        _escState, chr(bite), end='\r\n')
-            _escState = None
-        else:
-            print('bad escape sequence:', _escState, bite, end='\r\n')
-            _escState = None
-    elif isinstance(_escState, int):
-        if _escState == kSS3:
-            # TODO deal with sequence
-            print('ESC-O', chr(bite), end='\r\n')
-        else:
-            print('bad escape sequence:', kESC, _escState, bite, end='\r\n')
-        _escState = None
-    else:
-        raise RuntimeError("_escState broken: {}".format(_escState))
+    return sr.main.editor.addByte(bite)
 
+# Like addByte(), for any number of bytes at once (bytes, bytearray or
+# memoryview).  Returns a list of the lines completed.
+def addBytes(buffer):
+    return sr.main.editor.addBytes(buffer)
@@ -8,23 +8,39 @@
 # Tab completion optionally includes identifiers from an execution context.
 
 # Design remarks:
-# - The design uses module-as-singleton: it is not possible to maintain
-#   multiple separate readline states simultaneously.
+# - All the state of one readline is in an editor.LineEditor, so several
+#   can be kept at once (socketConsole has one per connection).  The
+#   module-level functions (addByte() etc.) act on a default editor, which
+#   configure() sets up.
 # - As you can see, the module is broken up into several files.
 
 import sys
-#import rlcompleter
-#import simpleReadline as sr
+from simpleReadline.editor import LineEditor
+from simpleReadline.history import HistoryStore
 
-def configure(writeFn=None, context=None):
-    # TODO move context to the socket-oriented module?
+# If historyFile is given, the history is kept in that file (see
+# history.HistoryStore), up to historySize entries.
+def configure(writeFn=None, context=None, historyFile=None,
+        historySize=10000):
     global _writeFn, _context
     _writeFn = _defaultWriteFn if writeFn is None else writeFn
     _context = context
+    editor.writeFn = _writeFn
+    editor.context = _context
+    if isinstance(editor.history, HistoryStore):
+        editor.history.close()
+    if historyFile is None:
+        editor.history = list()
+    else:
+        editor.history = HistoryStore(historyFile, historySize)
 
 def _defaultWriteFn(bites):
     # This will fail if stdout is not a normal tty console
     sys.stdout.buffer.raw.write(bites)
 
 _writeFn = _defaultWriteFn
+_context = None
+
+# The default editor, used by the module-level functions
+editor = LineEditor(_writeFn)
 
@@ -0,0 +1,119 @@
+# Simplified version of Python readline module that does not require the
+# GNU readline package (which is available only on Linux).
+
+# Incremental history search (Ctrl-R and Ctrl-S).  HistoryIndex keeps, for
+# every three bytes that occur in the history (a trigram), the numbers of
+# the entries they occur in.  A search only looks at the entries that
+# have every trigram of what's being searched for, starting with the
+# rarest, so it doesn't matter how long the history is.  Searches for
+# fewer than three bytes just go through the history from where they are.
+
+import bisect
+from array import array
+
+_empty = array('I')
+
+# The index for history: the same one for every editor using a given
+# HistoryStore (which keeps it), a new one for a list.
+def indexFor(history):
+    if isinstance(history, list):
+        return HistoryIndex(history)
+    if history.index is None:
+        history.index = HistoryIndex(history)
+    return history.index
+
+class HistoryIndex:
+
+    __slots__ = (
+        'history',     # the list or HistoryStore indexed
+        'postings',    # trigram (bytes) -> array of entry numbers, rising
+        'indexed',     # how many entries are in postings
+        'generation',  # history's generation when indexed
+    )
+
+    def __init__(self, history):
+        self.history = history
+        self.postings = dict()
+        self.indexed = 0
+        self.generation = getattr(history, 'generation', 0)
+        self.update()
+
+    # Index any entries added to the history since last time.  A
+    # HistoryStore that has been compacted has renumbered its entries, so
+    # then it starts over.
+    def update(self):
+        history = self.history
+        generation = getattr(history, 'generation', 0)
+        if generation != self.generation or len(history) < self.indexed:
+            self.postings = dict()
+            self.indexed = 0
+            self.generation = generation
+        postings = self.postings
+        for i in range(self.indexed, len(history)):
+            entry = history[i]
+            for gram in {entry[j:j + 3] for j in range(len(entry) - 2)}:
+                numbers = postings.get(gram)
+                if numbers is None:
+                    numbers = postings[gram] = array('I')
+                numbers.append(i)
+        self.indexed = len(history)
+
+    # The number of the first entry that contains query (bytes), looking
+    # from entry start towards older entries (direction -1) or newer ones
+    # (direction 1), or None if there isn't one.
+    def find(self, query, start, direction):
+        self.update()
+        history = self.history
+        if len(query) < 3:
+            if direction < 0:
+                first, stop = min(start, len(history) - 1), -1
+            else:
+                first, stop = max(start, 0), len(history)
+            for i in range(first, stop, direction):
+                if query in history[i]:
+                    return i
+            return None
+        lists = sorted((self.postings.get(bytes(query[j:j + 3]), _empty)
+                for j in range(len(query) - 2)), key=len)
+        rarest = lists[0]
+        others = lists[1:]
+        if direction < 0:
+            candidates = range(bisect.bisect_right(rarest, start) - 1, -1, -1)
+        else:
+            candidates = range(bisect.bisect_left(rarest, start), len(rarest))
+        for k in candidates:
+            i = rarest[k]
+            if all(_contains(numbers, i) for numbers in others) and \
+                    query in history[i]:
+                return i
+        return None
+
+def _contains(numbers, i):
+    k = bisect.bisect_left(numbers, i)
+    return k < len(numbers) and numbers[k] == i
+
+class Search:
+
+    # The state of one Ctrl-R or Ctrl-S search, kept by the LineEditor.
+
+    __slots__ = (
+        'direction',  # -1 to look at older entries, 1 for newer
+        'query',      # bytearray being searched for
+        'match',      # number of the entry found, or None
+        'failed',     # whether the query as it is now wasn't found
+        'origin',     # where to look from before anything is found
+        'undo',       # (match, failed, typed) before each step, for Backspace;
+                      # typed is how many bytes it added to the query
+        'saved',      # (line, charPos, lineNo) to go back to if cancelled
+        'partial',    # bytearray: the start of a character still coming
+    )
+
+    def __init__(self, direction, origin, saved):
+        self.direction = direction
+        self.query = bytearray()
+        self.match = None
+        self.failed = False
+        self.origin = origin
+        self.undo = list()
+        self.saved = saved
+        self.partial = bytearray()
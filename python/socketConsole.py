@@ -1,121 +1,1799 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import ast
+import re
 import code
-import select
+import json
+import codeop
+import builtins
+import time
+import heapq
+import bisect
+import struct
+import weakref
+import reprlib
+import itertools
+import stat
+import errno
 import socket
+import asyncio
 import inspect
+import functools
+import selectors
 import threading
+import traceback
+import contextlib
+import contextvars
+import collections
+import collections.abc
+import streamRepr
+import sampleProfiler
+import simpleReadline
+try:
+    import ctypes
+except ImportError:
+    # Then statements can't be interrupted.
+    ctypes = None
 
-# How long to wait (sec) between checking for stopping.
-stopCheckDuration = 0.2
+# How long (sec) an idle session worker thread waits for another session
+# before it exits.
+workerIdleTime = 60.0
 
-_threadsToJoin = list()
-_stopRequest = False
+# Session output is collected and handed to the reactor to send once this
+# many bytes are waiting, or when the console prompts for input.
+flushSize = 16384
 
-def start(port, address='', multiple=False, symtab=None):
+# Code that has this many bytes of session output still unsent is held up
+# in write() until the client has read half of it.
+highWater = 1 << 20
+
+# How long (sec) a new connection has to send the RPC handshake byte before
+# it's taken to be an interactive console.
+handshakeTime = 0.05
+
+# The longest line (bytes) an asyncio console session takes; a longer one
+# is thrown away with an error, and the session goes on.
+maxLine = 1 << 24
+
+# How an expression's value is shown at the prompt: at most displayBytes
+# characters at first (%more shows the rest), nested at most displayDepth
+# deep, at most displayItems items per container.  None means no limit.
+# Sessions can change their own with %display.
+displayBytes = 1 << 16
+displayDepth = None
+displayItems = None
+
+# How many object handles an RPC browsing session keeps (see _HandleTable).
+browseHandles = 1000
+
+# Whether socketConsole logs connections and sessions coming and going.
+verbose = True
+
+# How many compiled statements all the sessions share a cache of.
+codeCacheSize = 512
+
+# The running _Reactor, if any.
+_server = None
+
+# The console that sys.stdout and sys.stderr write to in the current
+# context (thread or asyncio task), or None for the real streams.
+_sessionOut = contextvars.ContextVar('socketConsole.sessionOut',
+        default=None)
+
+def start(port, address='', multiple=False, symtab=None, wait=True,
+        maxSessions=8, whenFull='wait', backlog=5, timeout=None,
+        allowedUids=None, live=False, metricsPort=None, lineEditing=False,
+        historyFile=None):
+    # If port is a string, the console listens on that Unix domain socket
+    # path instead of TCP (address is ignored); '@name' means name in
+    # Linux's abstract namespace.  Only processes running as one of
+    # allowedUids (by default, our own uid and root) may connect to it.
+    # If wait is true (the default) this blocks until stop() is called,
+    # otherwise the console runs in the background and this returns
+    # immediately.
+    # At most maxSessions consoles run at once (just one if multiple is
+    # false).  When that many are open, whenFull says what to do with new
+    # connections: 'wait' leaves them queued in the listen backlog until a
+    # session ends, 'reject' tells them the console is busy and hangs up.
+    # If timeout is given, a statement that runs longer than that many
+    # seconds is interrupted with StatementTimeout.
+    # Each session starts with an empty namespace of its own that falls
+    # back on symtab, or if that's not given, on a copy of the caller's
+    # locals() taken now; with live, also on the caller's module globals
+    # as they change.  See _BaseNamespace.
+    # If metricsPort (a port number or Unix domain socket path) is given,
+    # anything connecting to it gets a plain text metrics() snapshot.
+    # With lineEditing, interactive sessions ask the client's telnet to send
+    # each key as it's typed, and the line is edited here, with history
+    # (see simpleReadline).  Only for telnet clients: others would see the
+    # telnet commands.  If historyFile is given, the sessions share one
+    # history, kept in that file.
+    global _server
+    if symtab is None:
+        symtab = _callerLayers(inspect.currentframe().f_back, live)
+    else:
+        symtab = [symtab]
+    if whenFull not in ('wait', 'reject'):
+        raise ValueError('whenFull must be \'wait\' or \'reject\'')
+    if not multiple:
+        maxSessions = 1
+    history = None
+    if lineEditing and historyFile is not None:
+        history = simpleReadline.HistoryStore(historyFile)
+    _installOutputProxies()
+    _server = _Reactor(_listen(port, address, backlog),
+            _BaseNamespace(symtab),
+            maxSessions, whenFull, timeout, _uidSet(allowedUids),
+            lineEditing, history)
+    if metricsPort is not None:
+        _server.addMetricsListener(_listen(metricsPort, address, backlog))
+    _server.start()
+    if wait:
+        # Ctrl-C (or anything else) while waiting stops the server too.
+        try:
+            _server.join()
+        except BaseException:
+            stop()
+            raise
+
+def start_async(port, address='', symtab=None, allowedUids=None,
+        live=False):
+    # Asyncio flavor of start().  Returns a coroutine that starts serving
+    # on the running loop and produces the asyncio.Server, e.g.
+    #     server = await socketConsole.start_async(5000)
+    # Each session is a coroutine on the loop, and statements run on the
+    # loop's own thread, so they can look at loop state without racing it.
+    # A string port is a Unix domain socket, and symtab and live work, as
+    # for start().
     if symtab is None:
-        # Get a copy of the caller's locals() to use as context.
-        symtab = dict(inspect.currentframe().f_back.f_locals)
-    _listen((address, port), multiple, symtab)
+        symtab = _callerLayers(inspect.currentframe().f_back, live)
+    else:
+        symtab = [symtab]
+    _installOutputProxies()
+    handler = functools.partial(_asyncConsole,
+            symtab=_BaseNamespace(symtab),
+            allowedUids=_uidSet(allowedUids))
+    if isinstance(port, str):
+        return asyncio.start_unix_server(handler, _prepareUnixPath(port),
+                limit=maxLine)
+    return asyncio.start_server(handler, address or None, port,
+            limit=maxLine)
 
 def stop():
-    # TODO make sure this works when called from a console
-    global _threadsToJoin, _stopRequest
-    _stopRequest = True
-    thisThread = threading.current()
-    for t in _threadsToJoin:
-        if t is not thisThread:
-            t.join()
-    _threadsToJoin.clear()
-
-def _listen(addrPort, multiple, symtab):
-    # Within this function, sock is the socket we listen on for connections.
-    global stopCheckDuration, _stopRequest, _threadsToJoin
-    sock = socket.socket()
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(addrPort)
-    sock.listen(1)
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server = None
+
+def address():
+    # The address the running console listens on (useful after start()
+    # with port 0).
+    return None if _server is None else _server.listenSock.getsockname()
+
+def metrics():
+    # What the console is doing and has cost so far, as a dict; see
+    # _Reactor.metrics().  Empty if it isn't running.
+    server = _server
+    return {} if server is None else server.metrics()
+
+def codeCacheInfo():
+    # Statistics for the compiled-statement cache, as a dict.
+    return _codeCache.info()
+
+# The namespaces a session falls back on when started from frame.
+def _callerLayers(frame, live):
+    if not live:
+        return [dict(frame.f_locals)]
+    if frame.f_locals is frame.f_globals:
+        # Called at module level
+        return [frame.f_globals]
+    return [dict(frame.f_locals), frame.f_globals]
+
+class _BaseNamespace(dict):
+
+    # The read-only part of the sessions' namespaces, shared by all of
+    # them.  Each session's own namespace is a small dict of the names it
+    # assigns, with this as its __builtins__, so names it doesn't have are
+    # looked up in layers (in order) and then in the real builtins, and
+    # starting a session costs the same however big the layers are.
+    # The builtins are copied in here because the interpreter looks some
+    # of them (e.g. __import__) up directly; any that a layer overrides are
+    # left out so the layer wins.  A session can't see or delete the
+    # layers' names with globals(), dir() or del, only use them.
+
+    def __init__(self, layers):
+        super().__init__(builtins.__dict__)
+        self.layers = layers
+        for layer in layers:
+            for name in layer.keys() & self.keys():
+                if name not in ('__import__', '__build_class__'):
+                    del self[name]
+
+    def __missing__(self, name):
+        for layer in self.layers:
+            try:
+                return layer[name]
+            except KeyError:
+                pass
+        return builtins.__dict__[name]
+
+class _OutputProxy:
+
+    # Stands in for sys.stdout or sys.stderr.  What a session's code
+    # writes goes to that session's socket; every other thread of the
+    # process still writes to the real stream.
+
+    def __init__(self, real):
+        self.real = real
+
+    def write(self, s):
+        session = _sessionOut.get()
+        if session is None:
+            return self.real.write(s)
+        session.write(s)
+        return len(s)
+
+    def flush(self):
+        session = _sessionOut.get()
+        if session is None:
+            self.real.flush()
+        else:
+            session.flush()
+
+    def isatty(self):
+        return _sessionOut.get() is None and self.real.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+# Also installs the display hook, which shows values typed at a session's
+# prompt the session's way (see _ConsoleBase.display()).
+def _installOutputProxies():
+    if not isinstance(sys.stdout, _OutputProxy):
+        sys.stdout = _OutputProxy(sys.stdout)
+    if not isinstance(sys.stderr, _OutputProxy):
+        sys.stderr = _OutputProxy(sys.stderr)
+    if sys.displayhook is not _displayHook:
+        _displayHook.real = sys.displayhook
+        sys.displayhook = _displayHook
+
+def _displayHook(value):
+    session = _sessionOut.get()
+    if session is None:
+        _displayHook.real(value)
+    else:
+        session.display(value)
+
+# socketConsole's own diagnostics, which go to the process's real stderr
+# even from a session's thread.
+def _log(*args):
+    if not verbose:
+        return
+    stderr = sys.stderr
+    if isinstance(stderr, _OutputProxy):
+        stderr = stderr.real
+    print(*args, file=stderr)
+
+def _listen(port, address, backlog):
+    # Return a socket listening for connections on port, which is a TCP
+    # port number or a Unix domain socket path.
+    if isinstance(port, str):
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(_prepareUnixPath(port))
+    else:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, port))
+    sock.listen(backlog)
     sock.setblocking(False)
-    slist = (sock,)
-    empty = tuple()
-    while True:
-        readable, junk, junk = \
-                select.select(slist, empty, empty, stopCheckDuration)
-        if _stopRequest: break
-        #if len(readable) > 0 and readable[0] is sock:
-        if readable:
+    return sock
+
+# Turn a Unix domain socket name into a bindable address: '@name' becomes
+# the abstract name '\0name', and a leftover socket file at a real path
+# (from a process that died) is removed.  One that something is still
+# listening on is left alone, and raises EADDRINUSE.
+def _prepareUnixPath(path):
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX)
+            probe.settimeout(1.0)
+            try:
+                probe.connect(path)
+            except OSError as e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise OSError(errno.EADDRINUSE,
+                            'cannot tell if {} is in use: {}'.format(path, e))
+                os.unlink(path)
+            else:
+                raise OSError(errno.EADDRINUSE,
+                        '{} is in use by another process'.format(path))
+            finally:
+                probe.close()
+    except FileNotFoundError:
+        pass
+    return path
+
+def _uidSet(allowedUids):
+    if allowedUids is None and hasattr(os, 'getuid'):
+        return frozenset((os.getuid(), 0))
+    return None if allowedUids is None else frozenset(allowedUids)
+
+# Return whether the process at the other end of a Unix domain socket is
+# running as one of allowedUids.  Other sockets are always allowed.
+def _peerAllowed(conn, allowedUids):
+    if conn.family != socket.AF_UNIX or allowedUids is None or \
+            not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    if uid in allowedUids:
+        return True
+    _log('refused pid', pid, 'uid', uid)
+    return False
+
+class _Reactor:
+
+    # One background thread owns the listening socket and every session
+    # socket and does all the waiting for I/O, so an idle console costs
+    # nothing.  Other threads hand it work with callSoon(), which writes
+    # a byte to a socket pair to wake the selector up immediately.
+
+    def __init__(self, listenSock, symtab, maxSessions, whenFull, timeout,
+            allowedUids, lineEditing=False, history=None):
+        self.selector = selectors.DefaultSelector()
+        self.listenSock = listenSock
+        self.allowedUids = allowedUids
+        self.symtab = symtab   # the _BaseNamespace
+        self.maxSessions = maxSessions
+        self.whenFull = whenFull
+        self.timeout = timeout
+        self.lineEditing = lineEditing
+        self.history = history   # shared HistoryStore, only used by us
+        self.accepting = True
+        self.pool = _SessionPool(maxSessions)
+        self.sessions = dict()   # socket -> SocketInteractiveConsole
+        self.handshakes = dict()  # socket -> _Timer, not yet a session
+        self.calls = collections.deque()  # callables queued by callSoon()
+        self.timers = list()   # heap of _Timer, only touched by the reactor
+        self.metricsSocks = list()
+        # Counters, only written by the reactor thread so they need no
+        # lock.  Sessions count their own traffic, and add it to these
+        # totals when they close.
+        self.accepts = 0
+        self.rejects = 0
+        self.wakeups = 0   # returns from select(), timeouts included
+        self.sessionsClosed = 0
+        self.closedBytesIn = 0
+        self.closedBytesOut = 0
+        self.closedStatements = _Histogram()
+        self.closedSendStalls = 0
+        self.closedThrottles = 0
+        self.stopRequest = False
+        self.wakeRecv, self.wakeSend = socket.socketpair()
+        self.wakeRecv.setblocking(False)
+        self.wakeSend.setblocking(False)
+        self.selector.register(self.wakeRecv, selectors.EVENT_READ,
+                self._onWake)
+        self.selector.register(listenSock, selectors.EVENT_READ,
+                self._onAccept)
+        self.thread = threading.Thread(target=self._run,
+                name='socketConsole', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # Serve metricsText() to whatever connects to sock.  Call before start().
+    def addMetricsListener(self, sock):
+        self.metricsSocks.append(sock)
+        self.selector.register(sock, selectors.EVENT_READ,
+                functools.partial(self._onMetricsAccept, sock))
+
+    def metrics(self):
+        sessions = list(self.sessions.values())
+        statements = _Histogram()
+        statements.merge(self.closedStatements)
+        for session in sessions:
+            statements.merge(session.statements)
+        return dict(
+            activeSessions=len(sessions),
+            accepts=self.accepts,
+            rejects=self.rejects,
+            sessionsClosed=self.sessionsClosed,
+            selectWakeups=self.wakeups,
+            bytesIn=self.closedBytesIn + sum(s.bytesIn for s in sessions),
+            bytesOut=self.closedBytesOut + sum(s.bytesOut for s in sessions),
+            sendStalls=self.closedSendStalls +
+                    sum(s.sendStalls for s in sessions),
+            writeThrottles=self.closedThrottles +
+                    sum(s.throttles for s in sessions),
+            statements=statements.summary(),
+            sessions=[s.metrics() for s in sessions],
+            codeCache=codeCacheInfo())
+
+    # metrics() as lines of "name value".
+    def metricsText(self):
+        m = self.metrics()
+        lines = list()
+        for name, value in m.items():
+            if name == 'sessions':
+                for session in value:
+                    lines.append('session {}'.format(' '.join(
+                            '{}={}'.format(k, v) for k, v in session.items()
+                            if not isinstance(v, dict))))
+            elif isinstance(value, dict):
+                for k, v in value.items():
+                    lines.append('{}.{} {}'.format(name, k, v))
+            else:
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def join(self):
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def stop(self):
+        self.stopRequest = True
+        self._wake()
+        self.join()
+        self.pool.shutdown()
+
+    # Run fn(*args) on the reactor thread.  Safe to call from any thread.
+    def callSoon(self, fn, *args):
+        self.calls.append(functools.partial(fn, *args))
+        self._wake()
+
+    # Run fn(*args) on the reactor thread after delay seconds, unless the
+    # returned _Timer is cancelled first.  Safe to call from any thread.
+    def callLater(self, delay, fn, *args):
+        timer = _Timer(time.monotonic() + delay, functools.partial(fn, *args))
+        self.callSoon(heapq.heappush, self.timers, timer)
+        return timer
+
+    def _wake(self):
+        try:
+            self.wakeSend.send(b'\0')
+        except (BlockingIOError, OSError):
+            # The pipe is full (so a wakeup is already pending) or closed.
+            pass
+
+    def _run(self):
+        while not self.stopRequest:
+            ready = self.selector.select(self._runTimers())
+            self.wakeups += 1
+            for key, events in ready:
+                self._safely(key.data, events, sock=key.fileobj)
+                if self.stopRequest: break
+        self._shutdown()
+
+    # Run fn(*args), a callback for the socket sock (if any).  An exception
+    # in it is logged and ends only the session (or connection) it was for,
+    # rather than the reactor thread and with it every session.
+    def _safely(self, fn, *args, sock=None):
+        try:
+            fn(*args)
+        except Exception:
+            _log('exception on the reactor thread:\n' +
+                    traceback.format_exc().rstrip())
+            self._drop(sock, fn)
+
+    def _drop(self, sock, fn):
+        session = self.sessions.get(sock)
+        if session is None:
+            session = self._sessionOf(fn)
+        if session is not None:
+            sock = session.sock
+            try:
+                self._closeSession(session)
+                return
+            except Exception:
+                _log('closing session #', session.ident, 'failed:\n' +
+                        traceback.format_exc().rstrip())
+        if sock is None or sock is self.listenSock or \
+                sock is self.wakeRecv or sock in self.metricsSocks:
+            return
+        self.sessions.pop(sock, None)
+        timer = self.handshakes.pop(sock, None)
+        if timer is not None:
+            timer.cancel()
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+        self._resumeAccepting()
+
+    # The session a queued call or timer is for, if it's one of ours.
+    def _sessionOf(self, fn):
+        candidates = list(getattr(fn, 'args', ()))
+        func = getattr(fn, 'func', fn)
+        candidates.append(getattr(func, '__self__', None))
+        for candidate in candidates:
+            if isinstance(candidate, _ConsoleBase) and \
+                    self.sessions.get(candidate.sock) is candidate:
+                return candidate
+        return None
+
+    # Run the timers that are due, and return how long until the next one
+    # (None if there isn't one) for use as the select() timeout.
+    def _runTimers(self):
+        timers = self.timers
+        while timers:
+            timer = timers[0]
+            if timer.cancelled:
+                heapq.heappop(timers)
+                continue
+            delay = timer.when - time.monotonic()
+            if delay > 0:
+                return delay
+            heapq.heappop(timers)
+            self._safely(timer.fn)
+        return None
+
+    def _onWake(self, events):
+        try:
+            while self.wakeRecv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            self._safely(self.calls.popleft())
+
+    def _onAccept(self, events):
+        try:
+            conn, addr = self.listenSock.accept()
+        except BlockingIOError:
+            return
+        _log('accepted from', addr or conn.getsockname())
+        self.accepts += 1
+        if not _peerAllowed(conn, self.allowedUids):
+            self.rejects += 1
+            conn.close()
+            return
+        if self._sessionCount() >= self.maxSessions:
+            # Only happens with whenFull == 'reject'.
+            self.rejects += 1
+            try:
+                conn.send(b'Too many console sessions; try again later.\n')
+            except OSError:
+                pass
+            conn.close()
+            return
+        conn.setblocking(False)
+        # Wait for the first byte (or handshakeTime) to find out whether
+        # this is a person or an RPC client.
+        self.handshakes[conn] = self.callLater(handshakeTime,
+                self._startSession, conn, addr, b'')
+        self.selector.register(conn, selectors.EVENT_READ,
+                functools.partial(self._onHandshake, conn, addr))
+        if self._sessionCount() >= self.maxSessions and \
+                self.whenFull == 'wait':
+            # Leave further connections in the listen backlog until a
+            # session ends.
+            self.selector.unregister(self.listenSock)
+            self.accepting = False
+
+    def _onMetricsAccept(self, sock, events):
+        try:
             conn, addr = sock.accept()
-            print('accepted from', addr)
-            conn.setblocking(False)
-            if multiple:
-                t = threading.Thread(target=_console, args=(conn, addr, symtab))
-                _threadsToJoin.append(t)
+        except BlockingIOError:
+            return
+        if _peerAllowed(conn, self.allowedUids):
+            # A snapshot is small enough for the socket buffer, so a
+            # blocking send won't hold the reactor up.
+            try:
+                conn.sendall(self.metricsText().encode())
+            except OSError:
+                pass
+        conn.close()
+
+    def _sessionCount(self):
+        return len(self.sessions) + len(self.handshakes)
+
+    def _onHandshake(self, conn, addr, events):
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            self._startSession(conn, addr, data)
+        else:
+            self.handshakes.pop(conn).cancel()
+            self.selector.unregister(conn)
+            conn.close()
+            self._resumeAccepting()
+
+    # Start the console for a connection, given the data received so far.
+    # An RPC client's first byte is kRpcHandshake.
+    def _startSession(self, conn, addr, data):
+        self.handshakes.pop(conn).cancel()
+        bytesIn = len(data)
+        if data[:1] == kRpcHandshake:
+            session = _RpcConsole(conn, self.symtab, self)
+            data = data[1:]
+        else:
+            session = SocketInteractiveConsole(conn, self.symtab, self)
+        session.timeout = self.timeout
+        session.bytesIn += bytesIn
+        self.sessions[conn] = session
+        session.events = selectors.EVENT_READ
+        self.selector.modify(conn, session.events,
+                functools.partial(self._onSession, session))
+        if self.lineEditing and session.__class__ is SocketInteractiveConsole:
+            session.startLineEditing()
+        if data:
+            session.feed(data)
+        self.pool.submit(functools.partial(_console, session, addr))
+
+    def _onSession(self, session, events):
+        if events & selectors.EVENT_WRITE:
+            self._sendSome(session)
+        if not events & selectors.EVENT_READ:
+            return
+        try:
+            data = session.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            session.bytesIn += len(data)
+            session.feed(data)
+        else:
+            _log('EOF on SocketInteractiveConsole #', session.ident)
+            self._closeSession(session)
+
+    # Send as much of the session's pending output as the socket will take
+    # without blocking, and wait for it to be writable if that's not all.
+    def _sendSome(self, session):
+        sock = session.sock
+        if sock not in self.sessions:
+            return
+        with session.outReady:
+            session.flushPending = False
+            buf = session.outbuf
+            try:
+                if buf:
+                    sent = sock.send(buf)
+                    del buf[:sent]
+                    session.bytesOut += sent
+                    if buf:
+                        session.sendStalls += 1
+            except BlockingIOError:
+                session.sendStalls += 1
+            except OSError:
+                buf.clear()
+                session.closeWhenDrained = True
+            session.outReady.notify_all()
+            events = selectors.EVENT_READ
+            if buf:
+                events |= selectors.EVENT_WRITE
+        if not buf and session.closeWhenDrained:
+            self._closeSession(session)
+        elif events != session.events:
+            session.events = events
+            self.selector.modify(sock, events,
+                    self.selector.get_key(sock).data)
+
+    # Close a session once its remaining output has been sent.
+    def _finishSession(self, session):
+        session.closeWhenDrained = True
+        self._sendSome(session)
+
+    # Forget a session and close its socket.  Called on the reactor thread
+    # when the client disconnects or the console finishes, whichever
+    # happens first.
+    def _closeSession(self, session):
+        sock = session.sock
+        if self.sessions.pop(sock, None) is None:
+            return
+        session.close()
+        self.sessionsClosed += 1
+        self.closedBytesIn += session.bytesIn
+        self.closedBytesOut += session.bytesOut
+        self.closedStatements.merge(session.statements)
+        self.closedSendStalls += session.sendStalls
+        self.closedThrottles += session.throttles
+        self.selector.unregister(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        self._resumeAccepting()
+
+    def _resumeAccepting(self):
+        if not self.accepting and not self.stopRequest:
+            self.selector.register(self.listenSock, selectors.EVENT_READ,
+                    self._onAccept)
+            self.accepting = True
+
+    def _shutdown(self):
+        for session in list(self.sessions.values()):
+            self._closeSession(session)
+        for conn, timer in self.handshakes.items():
+            timer.cancel()
+            conn.close()
+        self.handshakes.clear()
+        self.selector.close()
+        if self.listenSock.family == socket.AF_UNIX:
+            path = self.listenSock.getsockname()
+            if isinstance(path, str) and path:
+                os.unlink(path)
+        self.listenSock.close()
+        for sock in self.metricsSocks:
+            sock.close()
+        self.wakeRecv.close()
+        self.wakeSend.close()
+        if self.history is not None:
+            self.history.close()
+        _log('_listen() exit')
+
+class _Timer:
+
+    __slots__ = ('when', 'fn', 'cancelled')
+
+    def __init__(self, when, fn):
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+class _Histogram:
+
+    # Counts of durations in buckets whose upper bounds double from 1 us
+    # to about a minute, plus one for anything longer.  Each is written by
+    # only one thread, so there's no lock; a reader may see it mid-update.
+
+    __slots__ = ('counts', 'total', 'seconds')
+
+    kBounds = [1e-6 * 2 ** i for i in range(26)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.kBounds) + 1)
+        self.total = 0
+        self.seconds = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.kBounds, seconds)] += 1
+        self.total += 1
+        self.seconds += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.seconds += other.seconds
+
+    # The upper bound of the bucket holding the p'th percentile.
+    def percentile(self, p):
+        rank = self.total * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.kBounds[i] if i < len(self.kBounds) \
+                        else float('inf')
+        return 0.0
+
+    def summary(self):
+        return dict(count=self.total, seconds=self.seconds,
+                p50=self.percentile(50), p90=self.percentile(90),
+                p99=self.percentile(99))
+
+class StatementTimeout(KeyboardInterrupt):
+    # Raised in a console statement that runs longer than its session's
+    # timeout.  It's a KeyboardInterrupt so "except Exception" in the
+    # user's code doesn't swallow it.
+    pass
+
+# Ask the interpreter to raise exctype in the thread with the given ident
+# the next time that thread runs Python code; exctype None cancels a
+# pending request.  Code stuck inside one long C call (a sleep, a huge
+# sort) only notices when the call returns.
+def _raiseInThread(ident, exctype):
+    if ctypes is None:
+        return False
+    exc = None if exctype is None else ctypes.py_object(exctype)
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(ident), exc) == 1
+
+class _SessionPool:
+
+    # The threads that run sessions.  Each session occupies a worker for
+    # as long as it lasts; workers are started only when none is idle, are
+    # reused for later sessions, and exit after workerIdleTime seconds
+    # without one, so a long-lived process doesn't pile up threads.
+
+    def __init__(self, maxWorkers):
+        self.maxWorkers = maxWorkers
+        self.cond = threading.Condition()
+        self.queue = collections.deque()  # sessions waiting for a worker
+        self.workers = set()
+        self.idle = 0       # number of workers waiting for a session
+        self.stopRequest = False
+
+    def submit(self, fn):
+        with self.cond:
+            self.queue.append(fn)
+            if self.idle > len(self.queue) - 1:
+                self.cond.notify()
+            elif len(self.workers) < self.maxWorkers:
+                t = threading.Thread(target=self._work,
+                        name='socketConsole-session', daemon=True)
+                self.workers.add(t)
                 t.start()
-            else:
-                _console(conn, addr, symtab)
-        if _stopRequest: break
-    sock.close()
-    _stopRequest = False
-    print('_listen() exit')
-
-def _console(sock, fromAddress, symtab):
-    # Within this function, sock is the socket from one connection.
-    c = SocketInteractiveConsole(sock, symtab)
-    c.interact()
-    sock.shutdown(socket.SHUT_RDWR)
-    sock.close()
-    print('_console() exit')
-    # TODO Should I bother to remove this thread from _threadsToJoin?
-
-class SocketInteractiveConsole(code.InteractiveConsole):
+
+    def _work(self):
+        thisThread = threading.current_thread()
+        while True:
+            with self.cond:
+                self.idle += 1
+                if not self.queue and not self.stopRequest:
+                    self.cond.wait(workerIdleTime)
+                self.idle -= 1
+                if not self.queue or self.stopRequest:
+                    self.workers.discard(thisThread)
+                    return
+                fn = self.queue.popleft()
+            # Whatever a session does, the worker carries on (and stays in
+            # workers) to serve the next one.
+            try:
+                fn()
+            except BaseException:
+                _log('exception in session worker:\n' +
+                        traceback.format_exc().rstrip())
+
+    # Wait for the workers to finish their sessions (except the calling
+    # thread, if it's one of them).
+    def shutdown(self):
+        with self.cond:
+            self.stopRequest = True
+            self.queue.clear()
+            self.cond.notify_all()
+            workers = list(self.workers)
+        thisThread = threading.current_thread()
+        for t in workers:
+            if t is not thisThread:
+                t.join()
+
+def _console(session, fromAddress):
+    # Runs on a pool worker; session.raw_input() blocks until the reactor
+    # has a line for it.
+    # sys.exit() in a session ends just that session.
+    token = _sessionOut.set(session)
+    try:
+        session.interact()
+    except SystemExit:
+        _log('SystemExit in', session.__class__.__name__, '#', session.ident)
+    finally:
+        _sessionOut.reset(token)
+        session.reactor.callSoon(session.reactor._finishSession, session)
+    _log('_console() exit')
+
+async def _asyncConsole(reader, writer, symtab, allowedUids):
+    # One session on the asyncio server; the same loop as interact(), but
+    # awaiting input instead of blocking a thread on it.
+    _log('accepted from', writer.get_extra_info('peername'))
+    if not _peerAllowed(writer.get_extra_info('socket'), allowedUids):
+        writer.close()
+        return
+    c = AsyncInteractiveConsole(writer, symtab)
+    # The task has its own context, so this doesn't leak to other tasks.
+    _sessionOut.set(c)
+    # Same defaults interact() uses.
+    if not hasattr(sys, 'ps1'):
+        sys.ps1 = '>>> '
+    if not hasattr(sys, 'ps2'):
+        sys.ps2 = '... '
+    c.write(c.banner())
+    more = False
+    try:
+        while not c.stopRequest:
+            if c.batch is None:
+                c.write(sys.ps2 if more else sys.ps1)
+            await writer.drain()
+            try:
+                data = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                data = e.partial  # the last line, with no LF, or EOF
+            except asyncio.LimitOverrunError:
+                await _skipLine(reader)
+                c.write('line too long (over {} bytes), ignored\n'.format(
+                        maxLine))
+                more = False
+                c.resetbuffer()
+                continue
+            if not data:
+                _log('EOF on AsyncInteractiveConsole #', c.ident)
+                break
+            line = data.decode()
+            if line.endswith('\n'):
+                # Remove trailing LF or CRLF
+                line = line[:-2] if line.endswith('\r\n') else line[:-1]
+            more = c.push(line)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+    _log('_asyncConsole() exit')
+
+async def _skipLine(reader):
+    # Throw away input up to and including the next LF (or EOF).
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            return
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+
+class _ConsoleBase(code.InteractiveConsole):
+
+    # What every console has in common regardless of transport: numbering,
+    # exit(), and compiling and running what the user types, including the
+    # console's own % commands.
 
     ident = 0  # Id of next instance; also counts instances
 
-    def __init__(self, sock, symtab):
-        self.sock = sock
+    # Lines starting with % (never valid Python) are console commands.
+    # Name -> (method name, help text).
+    commands = {
+        'help': ('_cmdHelp', 'list the console commands'),
+        'batch': ('_cmdBatch', '[N]  run the next N lines, or the lines up'
+                ' to %end (which also ends N early), as one block'),
+        'display': ('_cmdDisplay', '[bytes=N] [depth=N] [items=N]  limit'
+                ' how values are shown (0 for no limit)'),
+        'more': ('_cmdMore', '[N | all]  show more of the last value'),
+        'metrics': ('_cmdMetrics', ' show what the console is doing and'
+                ' has cost'),
+        'profile': ('_cmdProfile', 'start [interval] | stop | top [N] |'
+                ' folded | clear  sample where the process spends its time'),
+    }
+
+    def __init__(self, symtab):
         self.stopRequest = False
+        # Lines collected by %batch, or None
+        self.batch = None
+        self.batchCount = None
+        # How values are shown, and the rest of the last one (a generator
+        # of chunks) if it was cut short.
+        self.displayBytes = displayBytes
+        self.displayDepth = displayDepth
+        self.displayItems = displayItems
+        self.moreChunks = None
+        namespace = dict(__name__='__console__', __doc__=None,
+                __builtins__=symtab)
         # Make exit() in the console only exit the console, not the program.
         # (There's still sys.exit().)
-        symtab['exit'] = self.stop
-        self.linebuf = bytearray()
-        self.ident = SocketInteractiveConsole.ident
-        SocketInteractiveConsole.ident += 1
-        print('start SocketInteractiveConsole #', self.ident)
-        # TODO get the right context in here (locals)
+        namespace['exit'] = self.stop
+        self.ident = _ConsoleBase.ident
+        _ConsoleBase.ident += 1
+        _log('start', self.__class__.__name__, '#', self.ident)
         super().__init__(filename='<socket-' + str(self.ident) + '>',
-                locals=symtab)
+                locals=namespace)
+        self.compile = _CachingCompiler()
 
-    def raw_input(self, prompt):
-        global stopCheckDuration, _stopRequest
-        self.write(prompt)
-        slist = (self.sock,)
-        empty = tuple()
-        while True:
-            readable, junk, junk = \
-                    select.select(slist, empty, empty, stopCheckDuration)
-            if _stopRequest or self.stopRequest: break
-            if readable:
-                data = self.sock.recv(4096)
-                if len(data) > 0:
-                    #print('received', data)
-                    self.linebuf.extend(data)
-                    if self.linebuf[-1] == 10:
-                        # Remove trailing LF or CRLF
-                        del self.linebuf[-1]
-                        if self.linebuf[-1] == 13:
-                            del self.linebuf[-1]
-                        line = self.linebuf.decode()
-                        self.linebuf.clear()
-                        #print('returning line:', line)
-                        return line
+    # The greeting interact() writes, for consoles that don't use it.
+    def banner(self):
+        return 'Python {} on {}\n({})\n'.format(sys.version, sys.platform,
+                self.__class__.__name__)
+
+    def stop(self):
+        self.stopRequest = True
+
+    def push(self, line):
+        if self.batch is not None:
+            if line.strip() == '%end':
+                self._runBatch()
+            else:
+                self.batch.append(line)
+                if len(self.batch) == self.batchCount:
+                    self._runBatch()
+            return False
+        if not self.buffer and line.startswith('%'):
+            self.runCommand(line[1:])
+            return False
+        return super().push(line)
+
+    def runCommand(self, line):
+        name, junk, arg = line.strip().partition(' ')
+        if name not in self.commands:
+            self.write('Unknown command %{}; try %help\n'.format(name))
+            return
+        getattr(self, self.commands[name][0])(arg.strip())
+
+    def _cmdHelp(self, arg):
+        for name in sorted(self.commands):
+            self.write('%{} {}\n'.format(name, self.commands[name][1]))
+
+    def _cmdBatch(self, arg):
+        count = None
+        if arg:
+            try:
+                count = int(arg)
+                if count < 1:
+                    raise ValueError()
+            except ValueError:
+                self.write('usage: %batch [N]\n')
+                return
+        self.batchCount = count
+        self.batch = list()
+
+    # interact() calls this on Ctrl-C, which gives up on a batch too.
+    def resetbuffer(self):
+        super().resetbuffer()
+        self.batch = None
+        self.batchCount = None
+
+    # sys.displayhook for this session: stream the value's repr instead of
+    # building it all first, and stop after displayBytes.
+    def display(self, value):
+        if value is None:
+            return
+        self.locals['_'] = value
+        self.moreChunks = streamRepr.reprChunks(value, self.displayDepth,
+                self.displayItems)
+        self.showMore(self.displayBytes)
+
+    # Write up to limit more characters (None for all) of the last value.
+    def showMore(self, limit):
+        chunks = self.moreChunks
+        if chunks is None:
+            return
+        written = 0
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                written += len(chunk)
+                if limit is not None and written >= limit:
+                    self.write('\n... %more for the rest\n')
+                    return
+        except Exception as e:
+            self.moreChunks = None
+            # A dict or set changed size while being shown, or some repr
+            # (or the nesting) failed, which gets a traceback.
+            if type(e) is RuntimeError and 'during iteration' in str(e):
+                self.write('... changed while being shown\n')
+            else:
+                self.showtraceback()
+            return
+        self.moreChunks = None
+        self.write('\n')
+
+    def _cmdMore(self, arg):
+        if self.moreChunks is None:
+            self.write('nothing more to show\n')
+        elif arg == 'all':
+            self.showMore(None)
+        else:
+            try:
+                self.showMore(int(arg) if arg else self.displayBytes)
+            except ValueError:
+                self.write('usage: %more [N | all]\n')
+
+    def _cmdDisplay(self, arg):
+        try:
+            for setting in arg.split():
+                name, junk, value = setting.partition('=')
+                if name not in ('bytes', 'depth', 'items'):
+                    raise ValueError()
+                setattr(self, 'display' + name.capitalize(),
+                        int(value) or None)
+        except ValueError:
+            self.write('usage: %display [bytes=N] [depth=N] [items=N]\n')
+        self.write('bytes={} depth={} items={}\n'.format(self.displayBytes,
+                self.displayDepth, self.displayItems))
+
+    def _cmdMetrics(self, arg):
+        if _server is None:
+            self.write('no socketConsole server running\n')
+        else:
+            self.write(_server.metricsText())
+
+    def _cmdProfile(self, arg):
+        profiler = sampleProfiler.profiler
+        what, junk, arg = arg.partition(' ')
+        try:
+            if what == 'start':
+                profiler.start(float(arg) if arg else None)
+                self.write('profiling every {} s\n'.format(profiler.interval))
+            elif what == 'stop':
+                profiler.stop()
+            elif what == 'top' or what == '':
+                self.write(profiler.report(int(arg) if arg else 20))
+            elif what == 'folded':
+                for line in profiler.folded():
+                    self.write(line)
+            elif what == 'clear':
+                profiler.clear()
+            else:
+                raise ValueError()
+        except ValueError:
+            self.write('usage: %profile start [interval] | stop | top [N] |'
+                    ' folded | clear\n')
+
+    # Compile the collected batch once and run it, showing the value of
+    # each expression statement as if it had been typed at the prompt.
+    # No prompts are written while a batch is being collected, so the
+    # client gets all the results together.
+    def _runBatch(self):
+        source = '\n'.join(self.batch) + '\n'
+        self.batch = None
+        flags = self.compile.compiler.flags
+        try:
+            tree = compile(source, self.filename, 'exec',
+                    flags | ast.PyCF_ONLY_AST, True)
+            codeob = compile(ast.Interactive(tree.body), self.filename,
+                    'single', flags, True)
+        except (OverflowError, SyntaxError, ValueError):
+            self.showsyntaxerror(self.filename)
+            return
+        self.runcode(codeob)
+
+class _CodeCache:
+
+    # Least-recently-used cache of compiled statements, keyed by source
+    # text, compile mode and compiler flags, and shared by all sessions so
+    # scripts that poll the same expressions don't pay to compile them
+    # every time.  The code objects keep the filename of the session that
+    # compiled them first, which only shows in tracebacks.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Return (True, value) or (False, None).
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > codeCacheSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                    size=len(self.entries), maxSize=codeCacheSize)
+
+_codeCache = _CodeCache()
+
+class _CachingCompiler(codeop.CommandCompiler):
+
+    # What InteractiveConsole.runsource() compiles with, checking
+    # _codeCache first.  Incomplete input (None) is cached too; errors
+    # aren't.
+
+    def __call__(self, source, filename='<input>', symbol='single'):
+        key = (source, symbol, self.compiler.flags)
+        found, codeob = _codeCache.get(key)
+        if not found:
+            codeob = super().__call__(source, filename, symbol)
+            _codeCache.put(key, codeob)
+        elif codeob is not None:
+            # Remember __future__ imports, as codeop.Compile does.
+            for feature in codeop._features:
+                if codeob.co_flags & feature.compiler_flag:
+                    self.compiler.flags |= feature.compiler_flag
+        return codeob
+
+# Interrupt requests a client can send
+kCtrlC = b'\x03'
+kTelnetIP = b'\xff\xf4'        # IAC IP, Interrupt Process
+kTelnetDoTM = b'\xff\xfd\x06'   # IAC DO TIMING-MARK, sent after IAC IP
+kTelnetWillTM = b'\xff\xfb\x06'
+
+# Telnet commands for character at a time mode: we echo, and there are no
+# go-aheads.  See SocketInteractiveConsole.startLineEditing().
+kTelnetWillEcho = b'\xff\xfb\x01'
+kTelnetWillSGA = b'\xff\xfb\x03'
+kTelnetIAC = 255
+kTelnetSE = 240
+kTelnetSB = 250
+kTelnetNegotiate = (251, 252, 253, 254)  # WILL, WONT, DO, DONT
+kCR = 13
+
+# The bytes _feedEditor() doesn't just pass on to the editor
+_telnetSpecial = re.compile(rb'[\x03\r\xff]')
+
+class SocketInteractiveConsole(_ConsoleBase):
+
+    def __init__(self, sock, symtab, reactor):
+        self.sock = sock
+        self.reactor = reactor
+        self.eof = False
+        # Bytes received but not yet a full line, and full lines not yet
+        # read, both maintained by the reactor thread.
+        self.linebuf = bytearray()
+        self.lines = collections.deque()
+        self.ready = threading.Condition()
+        # Set by the reactor when Ctrl-C arrives between statements.
+        self.interruptRequest = False
+        # With line editing, the simpleReadline.LineEditor, and where the
+        # telnet command parser is, both only used by the reactor.
+        self.editor = None
+        self.telnetState = 0
+        self.lastCR = False
+        # Statement execution state, shared with the reactor thread.
+        self.timeout = None
+        self.execLock = threading.Lock()
+        self.execThread = None   # ident of the thread running a statement
+        # Output not yet sent, shared with the reactor, which does the
+        # sending.  outReady is notified whenever some of it goes out.
+        self.outbuf = bytearray()
+        self.outReady = threading.Condition()
+        self.flushPending = False
+        self.closeWhenDrained = False
+        self.events = 0   # what the reactor is selecting on for this socket
+        # Counters for metrics().  Traffic is counted by the reactor,
+        # statements and throttles by the session's own thread.
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.sendStalls = 0
+        self.throttles = 0
+        self.statements = _Histogram()
+        self.started = time.time()
+        super().__init__(symtab)
+
+    # Called by the reactor with data received from the socket.
+    def feed(self, data):
+        if self.editor is not None:
+            self._feedEditor(data)
+            return
+        if kCtrlC in data or kTelnetIP in data:
+            data = self._handleInterrupt(data)
+            if not data:
+                return
+        linebuf = self.linebuf
+        linebuf.extend(data)
+        end = linebuf.rfind(b'\n', len(linebuf) - len(data))
+        if end < 0:
+            return
+        # Queue every complete line; keep the partial one after the last LF.
+        lines = linebuf[:end].decode(errors='replace').split('\n')
+        del linebuf[:end + 1]
+        for i, line in enumerate(lines):
+            # Remove trailing CR of CRLF
+            if line.endswith('\r'):
+                lines[i] = line[:-1]
+        with self.ready:
+            self.lines.extend(lines)
+            self.ready.notify()
+
+    # Have the client's telnet send each key as it's typed, and not echo
+    # it; the editor does the echoing.
+    def startLineEditing(self):
+        self.editor = simpleReadline.LineEditor(self.writeBytes, self.locals,
+                self.reactor.history)
+        self.writeBytes(kTelnetWillEcho + kTelnetWillSGA)
+        self.flush()
+
+    # feed() for line editing: act on telnet commands and Ctrl-C, and hand
+    # the rest to the editor.
+    def _feedEditor(self, data):
+        editor = self.editor
+        state = self.telnetState
+        lines = list()
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            bite = data[pos]
+            if state == 0:
+                if self.lastCR:
+                    # Telnet sends Return as CR NUL or CR LF.
+                    self.lastCR = False
+                    if bite == 0 or bite == 10:
+                        pos += 1
+                        continue
+                match = _telnetSpecial.search(data, pos)
+                end = len(data) if match is None else match.start()
+                if end > pos:
+                    lines.extend(editor.addBytes(data[pos:end]))
+                    pos = end
+                    continue
+                pos += 1
+                if bite == kTelnetIAC:
+                    state = kTelnetIAC
+                elif bite == kCtrlC[0]:
+                    lines.clear()
+                    self._interruptInput()
                 else:
-                    print('EOF on SocketInteractiveConsole #', self.ident)
-                    break
+                    self.lastCR = True
+                    lines.extend(editor.addBytes(data[pos - 1:pos]))
+                continue
+            pos += 1
+            if state == kTelnetIAC:
+                # IAC IAC is a data byte 255, which UTF-8 never has.
+                if bite == kTelnetSB or bite in kTelnetNegotiate:
+                    state = bite
+                else:
+                    if bite == kTelnetIP[1]:
+                        lines.clear()
+                        self._interruptInput()
+                    state = 0
+            elif state == kTelnetSB:
+                # Subnegotiation runs up to IAC SE.
+                if bite == kTelnetIAC:
+                    state = kTelnetSE
+            elif state == kTelnetSE:
+                state = 0 if bite == kTelnetSE else kTelnetSB
+            else:
+                # The option of a WILL, WONT, DO or DONT: the client
+                # agreeing (or not) to character mode, or the timing mark
+                # that follows an IAC IP.
+                if kTelnetDoTM[1:] == bytes((state, bite)):
+                    self.writeBytes(kTelnetWillTM)
+                state = 0
+        self.telnetState = state
+        if lines:
+            with self.ready:
+                self.lines.extend(lines)
+                self.ready.notify()
+        self.flush()
+
+    # Called by the reactor when the connection is gone.
+    def close(self):
+        with self.ready:
+            self.eof = True
+            self.ready.notify()
+        with self.outReady:
+            self.outbuf.clear()
+            self.outReady.notify_all()
+
+    # Ctrl-C from the client (a raw ^C, or the telnet Interrupt Process
+    # command) interrupts the running statement, or if there isn't one,
+    # throws away the partial input the way a terminal would.  Returns
+    # data with the interrupt removed.
+    def _handleInterrupt(self, data):
+        if kTelnetDoTM in data:
+            # Telnet discards output until we answer its timing mark.
+            data = data.replace(kTelnetDoTM, b'')
+            self.writeBytes(kTelnetWillTM)
+        data = data.replace(kTelnetIP, b'').replace(kCtrlC, b'')
+        self._interruptInput()
+        return data
+
+    def _interruptInput(self):
+        if not self.interrupt(KeyboardInterrupt):
+            self.linebuf.clear()
+            if self.editor is not None:
+                self.editor.discard()
+            with self.ready:
+                self.lines.clear()
+                self.interruptRequest = True
+                self.ready.notify()
+
+    # Raise exctype in the statement this session is running, if any.
+    # Returns whether there was one to interrupt.
+    def interrupt(self, exctype):
+        with self.execLock:
+            if self.execThread is None:
+                return False
+            return _raiseInThread(self.execThread, exctype)
+
+    # Lets interrupt() and the timeout reach the statement run inside.
+    @contextlib.contextmanager
+    def executing(self):
+        ident = threading.get_ident()
+        start = time.perf_counter()
+        timer = None
+        with self.execLock:
+            self.execThread = ident
+            if self.timeout:
+                timer = self.reactor.callLater(self.timeout, self.interrupt,
+                        StatementTimeout)
+        try:
+            yield
+        finally:
+            # An interrupt that lands in here, after the statement is done,
+            # propagates to the caller (for interact(), that reports it
+            # like a ^C at the prompt).  One can land as soon as the lock is
+            # taken, so execThread is cleared in a finally: otherwise it
+            # would stay set, and later interrupts would hit whatever this
+            # thread went on to do.
+            with self.execLock:
+                try:
+                    pass
+                finally:
+                    self.execThread = None
+                    _raiseInThread(ident, None)
+            if timer is not None:
+                timer.cancel()
+            self.statements.add(time.perf_counter() - start)
+
+    def metrics(self):
+        peer = self.sock.getpeername() if self.sock.fileno() >= 0 else None
+        return dict(id=self.ident, kind=self.__class__.__name__,
+                peer=peer or 'local', age=time.time() - self.started,
+                bytesIn=self.bytesIn, bytesOut=self.bytesOut,
+                sendStalls=self.sendStalls, throttles=self.throttles,
+                statements=self.statements.summary())
+
+    def runcode(self, code):
+        with self.executing():
+            super().runcode(code)
+
+    def raw_input(self, prompt):
+        if self.editor is not None:
+            self.editor.prompt = prompt.encode()
+        if self.batch is None:
+            self.write(prompt)
+            self.flush()
+        with self.ready:
+            while not (self.lines or self.eof or self.stopRequest or
+                    self.interruptRequest):
+                self.ready.wait()
+            if self.interruptRequest:
+                self.interruptRequest = False
+                raise KeyboardInterrupt()
+            if self.lines and not self.stopRequest:
+                return self.lines.popleft()
         raise EOFError()
 
     def write(self, strdata):
-        self.sock.sendall(strdata.encode())
+        if self.editor is not None:
+            # The client's terminal is in raw mode.
+            strdata = strdata.replace('\n', '\r\n')
+        self.writeBytes(strdata.encode())
+
+    # Queue bites to be sent by the reactor.  Small writes just collect
+    # in outbuf until the next prompt.  Code that produces output faster
+    # than the client takes it is held up here (never the reactor itself).
+    def writeBytes(self, bites):
+        with self.outReady:
+            if self.eof:
+                return
+            self.outbuf.extend(bites)
+            if len(self.outbuf) < flushSize:
+                return
+        self.flush()
+        if threading.current_thread() is self.reactor.thread:
+            return
+        with self.outReady:
+            if len(self.outbuf) > highWater:
+                self.throttles += 1
+                while len(self.outbuf) > highWater // 2 and not self.eof:
+                    self.outReady.wait()
+
+    # Have the reactor start sending whatever output is waiting.
+    def flush(self):
+        with self.outReady:
+            if not self.outbuf or self.flushPending:
+                return
+            self.flushPending = True
+        if threading.current_thread() is self.reactor.thread:
+            self.reactor._sendSome(self)
+        else:
+            self.reactor.callSoon(self.reactor._sendSome, self)
 
     def stop(self):
-        self.stopRequest = True
+        with self.ready:
+            self.stopRequest = True
+            self.ready.notify()
+
+class AsyncInteractiveConsole(_ConsoleBase):
+
+    def __init__(self, writer, symtab):
+        self.writer = writer
+        super().__init__(symtab)
+
+    def flush(self):
+        # The transport sends as soon as it can anyway.
+        pass
+
+    def write(self, strdata):
+        # Buffered by the transport; _asyncConsole() drains it.
+        if not self.writer.is_closing():
+            self.writer.write(strdata.encode())
+
+# The first byte an RPC client sends.  A person at a terminal can't type it.
+kRpcHandshake = b'\0'
+
+# Longest RPC request accepted; anything bigger is taken as garbage.
+kRpcMaxFrame = 1 << 24
+
+class _RpcConsole(SocketInteractiveConsole):
+
+    # The machine-readable protocol, on the same port as the console.
+    # After the handshake byte, each request and response is a frame: a
+    # 4-byte big-endian length and then that many bytes of UTF-8 JSON.
+    # A request is
+    #     {"id": any, "source": str, "mode": "eval" | "exec" (optional)}
+    # and its response is
+    #     {"id": same, "result": repr or null, "stdout": str,
+    #      "exception": {"type": str, "text": traceback} or null,
+    #      "time": seconds}
+    # Without a mode, source is evaluated if it's an expression and
+    # executed otherwise.  A client may send any number of requests
+    # without waiting; they run in order, and each response is sent as
+    # soon as it's ready.
+    #
+    # Requests with an "op" browse objects by handle instead, so only the
+    # part being looked at crosses the wire.  Their result is JSON:
+    #     {"op": "inspect", "source": expr}  -> description of its value
+    #     {"op": "attrs", "handle": h, "start": i, "count": n}
+    #     {"op": "items", "handle": h, "start": i, "count": n}
+    #                                        -> list of [name or key repr,
+    #                                           description without handle]
+    #     {"op": "get", "handle": h, "attr": name}   -> description
+    #     {"op": "get", "handle": h, "index": i}     -> description
+    #     {"op": "release", "handles": [h, ...]}     -> null
+    # A description is {"handle": h, "type": str, "repr": short repr,
+    # "len": int or null}.  See _HandleTable for how long handles last.
+
+    captured = None   # list of output strings while a request runs
+    _handles = None   # _HandleTable, made when first needed
+
+    ops = {
+        'run': '_opRun',
+        'inspect': '_opInspect',
+        'attrs': '_opAttrs',
+        'items': '_opItems',
+        'get': '_opGet',
+        'release': '_opRelease',
+    }
+
+    # Called by the reactor with data received from the socket.
+    def feed(self, data):
+        linebuf = self.linebuf
+        linebuf.extend(data)
+        requests = list()
+        start = 0
+        while len(linebuf) - start >= 4:
+            size, = struct.unpack_from('>I', linebuf, start)
+            if size > kRpcMaxFrame:
+                _log('bad RPC frame on _RpcConsole #', self.ident)
+                self.reactor._closeSession(self)
+                return
+            if len(linebuf) - start - 4 < size:
+                break
+            requests.append(bytes(linebuf[start + 4:start + 4 + size]))
+            start += 4 + size
+        if requests:
+            del linebuf[:start]
+            with self.ready:
+                self.lines.extend(requests)
+                self.ready.notify()
+
+    def interact(self, banner=None, exitmsg=None):
+        while True:
+            with self.ready:
+                while not (self.lines or self.eof or self.stopRequest):
+                    self.ready.wait()
+                if not self.lines or self.stopRequest:
+                    return
+                frame = self.lines.popleft()
+            self.sendFrame(self.call(frame))
+
+    # Run one request frame, and return the response as a dict.
+    def call(self, frame):
+        response = dict(id=None, result=None, stdout='', exception=None,
+                time=0.0)
+        self.captured = list()
+        start = time.perf_counter()
+        try:
+            request = json.loads(frame)
+            response['id'] = request.get('id')
+            op = self.ops.get(request.get('op', 'run'))
+            if op is None:
+                raise ValueError('unknown op: {}'.format(request['op']))
+            with self.executing():
+                response['result'] = getattr(self, op)(request)
+        except SystemExit:
+            raise
+        except BaseException as e:
+            # Skip our own frames (call, _opRun, ...) the way
+            # InteractiveConsole.showtraceback skips its first one, so the
+            # text shows only the user's code.  An error raised before any
+            # user code ran (a SyntaxError, a bad op) gets no chain either.
+            tb = e.__traceback__
+            while tb is not None and \
+                    tb.tb_frame.f_code.co_filename == __file__:
+                tb = tb.tb_next
+            text = traceback.format_exception(type(e), e, tb,
+                    chain=tb is not None)
+            response['exception'] = dict(type=type(e).__name__,
+                    text=''.join(text))
+        response['time'] = time.perf_counter() - start
+        response['stdout'] = ''.join(self.captured)
+        self.captured = None
+        return response
+
+    def _opRun(self, request):
+        codeob, mode = self.compileRequest(request)
+        if mode == 'eval':
+            return repr(eval(codeob, self.locals))
+        exec(codeob, self.locals)
+        return None
+
+    def _opInspect(self, request):
+        codeob, mode = self.compileRequest(dict(request, mode='eval'))
+        return self.describe(eval(codeob, self.locals), strong=True)
+
+    def _opAttrs(self, request):
+        obj = self.handles.get(request['handle'])
+        names = self._page(sorted(dir(obj)), request)
+        result = list()
+        for name in names:
+            try:
+                value = getattr(obj, name)
+            except Exception as e:
+                result.append([name, dict(type=type(e).__name__,
+                        repr='<{}: {}>'.format(type(e).__name__, e),
+                        len=None)])
+            else:
+                result.append([name, self.describe(value, None)])
+        return result
+
+    def _opItems(self, request):
+        obj = self.handles.get(request['handle'])
+        return [[_shortRepr.repr(key), self.describe(value, None)]
+                for key, value in self._page(_browseItems(obj), request)]
+
+    def _opGet(self, request):
+        obj = self.handles.get(request['handle'])
+        if 'attr' in request:
+            value = getattr(obj, request['attr'])
+        else:
+            index = request['index']
+            pair = next(itertools.islice(_browseItems(obj), index, None),
+                    None)
+            if pair is None:
+                raise IndexError(index)
+            value = pair[1]
+        return self.describe(value)
+
+    def _opRelease(self, request):
+        for handle in request['handles']:
+            self.handles.release(handle)
+        return None
+
+    # The requested "start" and "count" slice of an iterable.
+    def _page(self, iterable, request):
+        start = request.get('start', 0)
+        count = request.get('count', 100)
+        return itertools.islice(iterable, start, start + count)
+
+    # Describe obj for a browsing client, and give it a handle unless
+    # strong is None.  Handles of values asked for by expression are held
+    # strongly, since nothing else may hold the value; see _HandleTable.
+    def describe(self, obj, strong=False):
+        try:
+            length = len(obj)
+        except Exception:
+            length = None
+        description = dict(type=type(obj).__qualname__,
+                repr=_shortRepr.repr(obj), len=length)
+        if strong is not None:
+            description['handle'] = self.handles.add(obj, strong)
+        return description
+
+    @property
+    def handles(self):
+        if self._handles is None:
+            self._handles = _HandleTable(browseHandles)
+        return self._handles
+
+    def compileRequest(self, request):
+        source = request['source']
+        mode = request.get('mode')
+        if mode is not None and mode not in ('eval', 'exec'):
+            raise ValueError('mode must be eval or exec')
+        key = (source, mode, 0)
+        found, result = _codeCache.get(key)
+        if found:
+            return result
+        if mode is None:
+            try:
+                result = compile(source, self.filename, 'eval'), 'eval'
+            except SyntaxError:
+                result = compile(source, self.filename, 'exec'), 'exec'
+        else:
+            result = compile(source, self.filename, mode), mode
+        _codeCache.put(key, result)
+        return result
+
+    def sendFrame(self, response):
+        payload = json.dumps(response).encode()
+        self.writeBytes(struct.pack('>I', len(payload)) + payload)
+        self.flush()
+
+    # Everything the request's code prints is returned in the response.
+    def write(self, strdata):
+        if self.captured is not None:
+            self.captured.append(strdata)
+
+# Short reprs for describing objects to a browsing client.
+_shortRepr = reprlib.Repr()
+_shortRepr.maxstring = 80
+_shortRepr.maxother = 80
+
+# (key, value) pairs for the items of obj: keys of a mapping, positions
+# in anything else iterable.  Lazy, so a page of a huge container only
+# costs what's on the page (and what's skipped to get there).
+def _browseItems(obj):
+    if isinstance(obj, collections.abc.Mapping):
+        return ((key, obj[key]) for key in obj)
+    if isinstance(obj, (str, bytes, collections.abc.Iterator)) or \
+            not isinstance(obj, collections.abc.Iterable):
+        # Browsing shouldn't use up an iterator, and characters of a
+        # string aren't worth a handle each.
+        return iter(())
+    return enumerate(obj)
+
+class StaleHandle(LookupError):
+    # Raised for an RPC browsing request naming a handle that's been
+    # released or evicted, or whose object has been garbage collected.
+    pass
+
+class _HandleTable:
+
+    # Objects a browsing client is looking at, by number.  Only the
+    # maxHandles most recently used handles are kept.  Handles found by
+    # browsing from another handle refer to the object weakly when they
+    # can, so browsing doesn't keep the host's objects alive, and go stale
+    # when the object goes away; the value of an expression is held
+    # strongly, as it may have been made just for the client.
+
+    def __init__(self, maxHandles):
+        self.maxHandles = maxHandles
+        self.entries = collections.OrderedDict()  # number -> (ref, weak)
+        self.numbers = itertools.count(1)
+
+    def add(self, obj, strong=False):
+        number = next(self.numbers)
+        weak = not strong
+        if weak:
+            try:
+                obj = weakref.ref(obj)
+            except TypeError:
+                weak = False
+        self.entries[number] = (obj, weak)
+        while len(self.entries) > self.maxHandles:
+            self.entries.popitem(last=False)
+        return number
+
+    def get(self, number):
+        try:
+            obj, weak = self.entries[number]
+        except KeyError:
+            raise StaleHandle(number) from None
+        if weak:
+            obj = obj()
+            if obj is None:
+                del self.entries[number]
+                raise StaleHandle(number)
+        self.entries.move_to_end(number)
+        return obj
 
+    def release(self, number):
+        self.entries.pop(number, None)
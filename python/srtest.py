@@ -10,26 +10,29 @@ oldtermios = None
 fd = None
 try:
     import msvcrt
-    getch = msvcrt.getch
+    def getch():
+        # Whatever has been typed (or pasted) so far, at least one byte
+        bites = msvcrt.getch()
+        while msvcrt.kbhit():
+            bites += msvcrt.getch()
+        return bites
 except ImportError:
     # assume Linux
-    import termios, tty
+    import os, termios, tty
     fd = sys.stdin.fileno()
     oldtermios = termios.tcgetattr(fd)
     tty.setraw(fd)
     def getch():
         # This will fail if stdin is not a normal tty console
-        return sys.stdin.buffer.raw.read(1)
+        return os.read(fd, 4096)
 
 foo = "bar"
 sr.configure(context=locals())
 while True:
     c = getch()
     #print('You typed:', repr(c), end='\r\n')
-    c = c[0]
-    if c == 3: break  # control-C
-    line = sr.addByte(c)
-    if line is not None:
+    if 3 in c: break  # control-C
+    for line in sr.addBytes(c):
         print('line:', line, end='\r\n')
         for c in line:
             print(ord(c), end=' ')
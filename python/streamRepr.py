@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# repr() for huge objects, produced a piece at a time.  repr() of a big
+# list or dict builds the entire string before anything can be done with
+# it; reprChunks() walks the structure lazily and yields the text in
+# chunks, so it can be sent as it's made and given up on part way.
+#
+# Only the exact built-in containers (and str and bytes) are walked; any
+# other object's own repr() is used whole, as the object may define it
+# however it likes.
+
+import itertools
+
+# Strings longer than this are shown as adjacent literals of this size
+# ('abc' 'def'), which reads back as the same string.
+kStringPiece = 4096
+
+# Yield the repr of obj in chunks of about chunkSize characters.  Nesting
+# deeper than depth, and items after the first items of each container,
+# are shown as '...' (None means no limit).
+def reprChunks(obj, depth=None, items=None, chunkSize=8192):
+    pending = list()
+    size = 0
+    for piece in _pieces(obj, depth, items, set()):
+        pending.append(piece)
+        size += len(piece)
+        if size >= chunkSize:
+            yield ''.join(pending)
+            pending.clear()
+            size = 0
+    if pending:
+        yield ''.join(pending)
+
+# Open and close text for each container type, and the text for an empty
+# one.
+_brackets = {
+    list: ('[', ']', '[]'),
+    tuple: ('(', ')', '()'),
+    set: ('{', '}', 'set()'),
+    frozenset: ('frozenset({', '})', 'frozenset()'),
+    dict: ('{', '}', '{}'),
+}
+
+def _pieces(obj, depth, items, active):
+    kind = type(obj)
+    if kind is str or kind is bytes:
+        if len(obj) <= kStringPiece:
+            yield repr(obj)
+        else:
+            for i in range(0, len(obj), kStringPiece):
+                if i:
+                    yield ' '
+                yield repr(obj[i:i + kStringPiece])
+        return
+    if kind not in _brackets:
+        yield repr(obj)
+        return
+    opening, closing, empty = _brackets[kind]
+    if not obj:
+        yield empty
+        return
+    if id(obj) in active:
+        # A container inside itself, shown the way repr() does.
+        yield '{...}' if kind is dict else opening + '...' + closing
+        return
+    if depth is not None and depth <= 0:
+        yield opening + '...' + closing
+        return
+    active.add(id(obj))
+    depth = None if depth is None else depth - 1
+    try:
+        yield opening
+        shown = obj.items() if kind is dict else obj
+        if items is not None:
+            shown = itertools.islice(shown, items)
+        for i, item in enumerate(shown):
+            if i:
+                yield ', '
+            if kind is dict:
+                yield from _pieces(item[0], depth, items, active)
+                yield ': '
+                yield from _pieces(item[1], depth, items, active)
+            else:
+                yield from _pieces(item, depth, items, active)
+        if items is not None and len(obj) > items:
+            yield ', ...'
+        if kind is tuple and len(obj) == 1:
+            yield ','
+        yield closing
+    finally:
+        active.discard(id(obj))